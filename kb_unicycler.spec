@@ -29,11 +29,14 @@ module kb_unicycler {
     short_paired_libraries - a list of short, paired end reads libraries
     short_unpaired_libraries - a list of short, paired end reads libraries
     long_reads_library - a long reads library
+    threads - number of threads to use; defaults to the number of CPUs
+              available to the container, and is capped at that number
 
     @optional min_contig_length
     @optional num_linear_seqs
     @optional bridging_mode
     @optional no_correct
+    @optional threads
     */
 
     typedef structure {
@@ -48,6 +51,7 @@ module kb_unicycler {
         int min_long_read_length;
         int num_linear_seqs;
         string bridging_mode;
+        int threads;
     } UnicyclerParams;
 
     /* Output parameters for Unicycler run.
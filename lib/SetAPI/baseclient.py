@@ -11,6 +11,9 @@ import json as _json
 import requests as _requests
 import random as _random
 import os as _os
+import threading as _threading
+from requests.exceptions import ConnectionError, ConnectTimeout, HTTPError
+from urllib3.exceptions import NewConnectionError
 
 try:
     from configparser import ConfigParser as _ConfigParser  # py 3
@@ -26,6 +29,104 @@ import time
 _CT = 'content-type'
 _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
+# connections kept open per host, and whether to keep them open at all
+_POOL_SIZE = int(_os.environ.get('KB_CLIENT_POOL_SIZE', '10'))
+_KEEP_ALIVE = _os.environ.get('KB_CLIENT_KEEP_ALIVE', 'true').lower() not in (
+    '0', 'false', 'no')
+# seconds to reuse a dynamic service url from the Service Wizard
+_URL_CACHE_SECONDS = float(_os.environ.get('KB_CLIENT_URL_CACHE_SECONDS', '300'))
+# retries of transient failures: at most _MAX_RETRIES per call, waiting a
+# random time up to _RETRY_BASE_DELAY * 2 ** retry (capped) before each, and
+# at most _RETRY_BUDGET retries in the process beyond one per ten
+# successful calls
+_MAX_RETRIES = int(_os.environ.get('KB_CLIENT_MAX_RETRIES', '5'))
+_RETRY_BUDGET = float(_os.environ.get('KB_CLIENT_RETRY_BUDGET', '20'))
+_RETRY_BUDGET_RATIO = 0.1
+_RETRY_BASE_DELAY = 1.0
+_RETRY_MAX_DELAY = 30.0
+_RETRY_STATUS = frozenset([502, 503, 504])
+# methods that only read, so are safe to call again after a failure that
+# the server may have seen
+_IDEMPOTENT_PREFIXES = ('get_', 'list_', 'check_', 'status', 'ver')
+
+
+_sessions = dict()
+_sessions_lock = _threading.Lock()
+
+
+def _get_session(url):
+    # one pooled session per process and host, shared by all clients and
+    # threads, so calls reuse open connections instead of paying for TCP
+    # and TLS setup every time
+    scheme, netloc, _, _, _, _ = _urlparse(url)
+    key = (_os.getpid(), scheme, netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _requests.Session()
+            session.mount(scheme + '://', _requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=_POOL_SIZE))
+            if not _KEEP_ALIVE:
+                session.headers['Connection'] = 'close'
+            _sessions[key] = session
+        return session
+
+
+# (service wizard url, module, version) -> (service url, expiry time),
+# shared by all clients in the process
+_service_urls = dict()
+_service_urls_lock = _threading.Lock()
+
+
+_retry_lock = _threading.Lock()
+_retry_tokens = [_RETRY_BUDGET]
+_retry_counts = {'retries': 0, 'budget_exhausted': 0, 'by_method': dict()}
+
+
+def retry_counts():
+    '''
+    Counts of retried calls in this process: total 'retries', retries
+    refused because the budget ran out ('budget_exhausted'), and retries per
+    method ('by_method').
+    '''
+    with _retry_lock:
+        counts = dict(_retry_counts)
+        counts['by_method'] = dict(_retry_counts['by_method'])
+        return counts
+
+
+def _is_idempotent(method):
+    name = method.split('.')[-1].lstrip('_')
+    # submitting an async job twice runs it twice
+    if name.endswith('_submit'):
+        return False
+    return name.startswith(_IDEMPOTENT_PREFIXES)
+
+
+def _not_sent(error):
+    # true if the connection was never made, so the server can't have seen
+    # the call
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _take_retry(method):
+    with _retry_lock:
+        if _retry_tokens[0] < 1:
+            _retry_counts['budget_exhausted'] += 1
+            return False
+        _retry_tokens[0] -= 1
+        _retry_counts['retries'] += 1
+        by_method = _retry_counts['by_method']
+        by_method[method] = by_method.get(method, 0) + 1
+        return True
+
+
+def _call_succeeded():
+    with _retry_lock:
+        _retry_tokens[0] = min(_RETRY_BUDGET, _retry_tokens[0] + _RETRY_BUDGET_RATIO)
 
 
 def _get_token(user_id, password, auth_svc):
@@ -160,7 +261,7 @@ class BaseClient(object):
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
 
-    def _call(self, url, method, params, context=None):
+    def _call(self, url, method, params, context=None, max_retries=_MAX_RETRIES):
         arg_hash = {'method': method,
                     'params': params,
                     'version': '1.1',
@@ -172,9 +273,27 @@ class BaseClient(object):
             arg_hash['context'] = context
 
         body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        retries = 0
+        while True:
+            try:
+                ret = _get_session(url).post(url, data=body, headers=self._headers,
+                                             timeout=self.timeout,
+                                             verify=not self.trust_all_ssl_certificates)
+                if ret.status_code in _RETRY_STATUS:
+                    ret.raise_for_status()
+                break
+            except (ConnectionError, HTTPError) as e:
+                if (retries >= max_retries or
+                        not (_is_idempotent(method) or _not_sent(e)) or
+                        not _take_retry(method)):
+                    raise
+                delay = _random.random() * min(_RETRY_MAX_DELAY,
+                                               _RETRY_BASE_DELAY * 2 ** retries)
+                retries += 1
+                print('Retrying {} in {:.1f} s (retry {}) after: {}'.format(
+                    method, delay, retries, e))
+                time.sleep(delay)
+        _call_succeeded()
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
@@ -196,13 +315,22 @@ class BaseClient(object):
             return resp['result'][0]
         return resp['result']
 
-    def _get_service_url(self, service_method, service_version):
+    def _get_service_url(self, service_method, service_version, refresh=False):
         if not self.lookup_url:
             return self.url
         service, _ = service_method.split('.')
+        key = (self.url, service, service_version)
+        now = time.time()
+        if not refresh:
+            with _service_urls_lock:
+                cached = _service_urls.get(key)
+            if cached is not None and cached[1] > now:
+                return cached[0]
         service_status_ret = self._call(
             self.url, 'ServiceWizard.get_service_status',
             [{'module_name': service, 'version': service_version}])
+        with _service_urls_lock:
+            _service_urls[key] = (service_status_ret['url'], now + _URL_CACHE_SECONDS)
         return service_status_ret['url']
 
     def _set_up_context(self, service_ver=None, context=None):
@@ -265,4 +393,14 @@ class BaseClient(object):
         '''
         url = self._get_service_url(service_method, service_ver)
         context = self._set_up_context(service_ver, context)
-        return self._call(url, service_method, args, context)
+        try:
+            return self._call(url, service_method, args, context)
+        except ConnectionError as e:
+            # the service may have moved since it was looked up; resending
+            # is a retry like any other, and _call has already backed off
+            if (not self.lookup_url or
+                    not (_is_idempotent(service_method) or _not_sent(e)) or
+                    not _take_retry(service_method)):
+                raise
+            url = self._get_service_url(service_method, service_ver, refresh=True)
+            return self._call(url, service_method, args, context, max_retries=0)
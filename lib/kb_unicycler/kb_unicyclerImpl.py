@@ -6,6 +6,7 @@ import re
 import uuid
 import requests
 import json
+import gzip
 import psutil
 import subprocess
 import numpy as np
@@ -13,18 +14,67 @@ import yaml
 import time
 import zipfile
 from pprint import pformat
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import sys
 from html import escape
 from shutil import copy, copytree, move
 
 from installed_clients.WorkspaceClient import Workspace
 from installed_clients.ReadsUtilsClient import ReadsUtils  # @IgnorePep8
-from installed_clients.baseclient import ServerError
+from installed_clients.baseclient import ServerError, retry_counts
 from installed_clients.AssemblyUtilClient import AssemblyUtil
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.kb_quastClient import kb_quast
 from SetAPI.SetAPIServiceClient import SetAPI
+from SetAPI.baseclient import retry_counts as setapi_retry_counts
+from kb_unicycler.utils.resources import (effective_cpu_count, effective_memory,
+                                          memory_caps_gb, ScratchUsage, ProcessSampler)
+from kb_unicycler.utils.combine import Combiner
+from kb_unicycler.utils.reads_cache import ReadsCache
+from kb_unicycler.utils.assembly_stats import assembly_stats
+from kb_unicycler.utils.packaging import select_members, write_zip
+from kb_unicycler.utils.console import ConsoleLog
+from kb_unicycler.utils.unicycler_log import UnicyclerLogParser
+from kb_unicycler.utils.ref_cache import RefCache, CachedWorkspace, CachedSetAPI
+from kb_unicycler.utils.seqscan import (fastq_read_lengths, fastq_read_stats, select_reads,
+                                        write_fastq_subset, fasta_record_lengths,
+                                        write_fasta_subset, index_fasta)
+
+# object_info tuple
+[OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I,
+    WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)
+
+# input types accepted for each kind of library
+READS_SET_TYPE = 'KBaseSets.ReadsSet'
+PAIRED_TYPES = ['KBaseFile.PairedEndLibrary', 'KBaseAssembly.PairedEndLibrary', READS_SET_TYPE]
+UNPAIRED_TYPES = ['KBaseFile.SingleEndLibrary', 'KBaseAssembly.SingleEndLibrary', READS_SET_TYPE]
+LONG_TYPES = ['KBaseGenomes.ContigSet', 'KBaseGenomeAnnotations.Assembly',
+              'KBaseFile.SingleEndLibrary', 'KBaseAssembly.SingleEndLibrary',
+              'KBaseFile.PairedEndLibrary', 'KBaseAssembly.PairedEndLibrary']
+
+# most ReadsSets fetched from SetAPI at once
+MAX_SET_WORKERS = 8
+# most reads libraries downloaded at once
+MAX_DOWNLOAD_WORKERS = 3
+# limit on the total length of the long reads
+MAX_LONG_READ_BASES = 1000000000
+# long reads libraries bigger than this aren't worth downloading to filter
+MAX_LONG_READ_DOWNLOAD_BASES = 10 * MAX_LONG_READ_BASES
+# default size limit of the reads cache, if one is configured
+DEFAULT_READS_CACHE_GB = 100
+# report page, and the contig table it loads
+REPORT_FILE = 'unicycler_report.html'
+CONTIG_DATA_FILE = 'unicycler_contigs.json.gz'
+# QUAST's page, moved into the report folder and appended to the output zip
+QUAST_REPORT_FILE = 'quast_report.html'
+# full log of the app, linked from the report
+CONSOLE_LOG_FILE = 'unicycler_console.log.gz'
+# default seconds between samples of unicycler's resource use, and where
+# the samples go in the output
+DEFAULT_SAMPLE_SECONDS = 10
+RESOURCE_USAGE_FILE = 'resource_usage.csv'
 #END_HEADER
 
 
@@ -55,56 +105,60 @@ A wrapper for the unicycler assembler
         print(message)
         sys.stdout.flush()
 
-    # from kb_SPAdes/utils/spades_utils.py:
+    # work out how many threads unicycler (and SPAdes, Racon and Pilon
+    # under it) should use, from the container's cgroup limits
+    def get_thread_count(self, console, params):
+        resources = effective_cpu_count()
+        self.log(console, 'CPUs: host '+str(resources['host_cpus']) +
+                 ', cpuset '+str(resources['cpuset_cpus']) +
+                 ', cgroup quota '+str(resources['cpu_quota']))
+        threads = resources['threads']
+        if 'threads' in params and params['threads'] is not None and int(params['threads']) > 0:
+            requested = int(params['threads'])
+            if requested > threads:
+                self.log(console, 'Requested '+str(requested)+' threads, but only ' +
+                         str(threads)+' CPUs are available; using '+str(threads))
+            else:
+                threads = requested
+        self.log(console, 'Using '+str(threads)+' threads')
+        return threads
+
+    # size the SPAdes memory limit and the Pilon java heap to fit the
+    # container's memory limit
+    def get_memory_caps(self, console):
+        resources = effective_memory()
+        self.log(console, 'Memory: host '+str(resources['host_memory']) +
+                 ' B, cgroup limit '+str(resources['cgroup_memory'])+' B')
+        caps = memory_caps_gb(resources['memory'])
+        caps['memory'] = resources['memory']
+        self.log(console, 'Using SPAdes memory limit '+str(caps['spades_memory_gb']) +
+                 ' GB, Pilon heap '+str(caps['pilon_heap_gb'])+' GB')
+        return caps
+
+    # write a pilon wrapper script with the given java heap size; returns
+    # None (keep unicycler's default pilon) if the jar can't be found
+    def write_pilon_wrapper(self, console, heap_gb):
+        pilon_jar = os.environ.get('PILON_JAR')
+        if pilon_jar is None or not os.path.isfile(pilon_jar):
+            self.log(console, 'Pilon jar not found; using default pilon heap size')
+            return None
+        pilon_path = os.path.join(self.scratch, 'pilon_'+str(uuid.uuid4()))
+        with open(pilon_path, 'w') as f:
+            f.write('#!/bin/bash\n')
+            f.write('exec /usr/bin/java -Xmx'+str(heap_gb)+'G -jar '+pilon_jar+' "$@"\n')
+        os.chmod(pilon_path, 0o755)
+        return pilon_path
+
+    # index the assembly in one pass; returns a numpy table with one row
+    # per contig (see seqscan.index_fasta)
     def load_stats(self, console, input_file_name):
-        self.log(console, 'Starting conversion of FASTA to KBaseGenomeAnnotations.Assembly')
-        # self.log(console, 'Building Object.')
+        self.log(console, 'Indexing contigs in '+input_file_name)
         if not os.path.isfile(input_file_name):
             raise Exception('The input file name {0} is not a file!'.format(input_file_name))
-        with open(input_file_name, 'r') as input_file_handle:
-            contig_id = None
-            sequence_len = 0
-            length_dict = dict()
-            coverage_dict = dict()
-            circ_dict = dict()
-            first_header_found = False
-            # Pattern for replacing white space
-            pattern = re.compile(r'\s+')
-            for current_line in input_file_handle:
-                if (current_line[0] == '>'):
-                    # found a header line
-                    # Wrap up previous fasta sequence
-                    if not first_header_found:
-                        first_header_found = True
-                    else:
-                        length_dict[contig_id] = sequence_len
-                        sequence_len = 0
-                    fasta_header = current_line.replace('>', '').strip()
-                    # self.log(console, 'fasta header = '+fasta_header)
-                    try:
-                        fields = fasta_header.strip().split(' ')
-                        contig_id = fields[0]
-                        # don't trust length from header, we look at seqence:
-                        # sequence_len = int(fields[1][7:]) if (fields[1].startswith('length=')) else 0
-                        coverage = float(
-                            fields[2][6:-1]) if (fields[2].startswith('depth=')) else 0.0
-                        circ = 'Y' if ((len(fields) > 3) and (
-                            'circular=true' in fields[3])) else 'N'
-                        # length_dict[contig_id] = sequence_len
-                        coverage_dict[contig_id] = coverage
-                        circ_dict[contig_id] = circ
-                    except (IndexError, ValueError, KeyError):
-                        contig_id = fasta_header.strip()
-                        coverage_dict[contig_id] = 0
-                        circ_dict[contig_id] = 'N'
-                else:
-                    sequence_len += len(re.sub(pattern, '', current_line))
-        # wrap up last fasta sequence
-        if not first_header_found:
+        contigs = index_fasta(input_file_name)
+        if len(contigs) == 0:
             raise Exception("There are no contigs in this file")
-        else:
-            length_dict[contig_id] = sequence_len
-        return [length_dict, coverage_dict, circ_dict]
+        return contigs
 
     # from kb_SPAdes/utils/spades_utils.py:
     def mkdir_p(self, path):
@@ -142,26 +196,24 @@ A wrapper for the unicycler assembler
         return lines
 
     # from kb_SPAdes/utils/spades_utils.py:
-    def zip_folder(self, folder_path, output_path):
+    def zip_folder(self, folder_path, output_path, include=None, exclude=(), threads=1):
         """
         zip_folder: Zip the contents of an entire folder (with that folder included
-        in the archive). Empty subfolders could be included in the archive as well
-        if the commented portion is used.
+        in the archive). include and exclude are glob patterns for the paths to
+        package, relative to the folder (see packaging.select_members); members are
+        compressed on up to threads threads, and already-compressed files are stored.
         """
-        with zipfile.ZipFile(output_path, 'w',
-                             zipfile.ZIP_DEFLATED,
-                             allowZip64=True) as ziph:
-            for root, folders, files in os.walk(folder_path):
-                for f in files:
-                    absolute_path = os.path.join(root, f)
-                    relative_path = os.path.join(os.path.basename(root), f)
-                    # print "Adding {} to archive.".format(absolute_path)
-                    ziph.write(absolute_path, relative_path)
+        members = []
+        for absolute_path, relative in select_members(folder_path, include, exclude):
+            relative_path = os.path.join(os.path.basename(os.path.dirname(absolute_path)),
+                                         os.path.basename(absolute_path))
+            members.append((absolute_path, relative_path))
+        write_zip(members, output_path, workers=max(1, threads))
 
         print("{} created successfully.".format(output_path))
 
     # from kb_SPAdes/utils/spades_utils.py:
-    def generate_output_file_list(self, console, out_dir):
+    def generate_output_file_list(self, console, out_dir, exclude=(), threads=1):
         """
         _generate_output_file_list: zip result files and generate file_links for report
         """
@@ -172,7 +224,7 @@ A wrapper for the unicycler assembler
         output_directory = os.path.join(self.scratch, str(uuid.uuid4()))
         self.mkdir_p(output_directory)
         unicycler_output = os.path.join(output_directory, 'unicycler_output.zip')
-        self.zip_folder(out_dir, unicycler_output)
+        self.zip_folder(out_dir, unicycler_output, exclude=exclude, threads=threads)
 
         output_files.append({'path': unicycler_output,
                              'name': os.path.basename(unicycler_output),
@@ -184,23 +236,87 @@ A wrapper for the unicycler assembler
     # adapted from kb_SPAdes/utils/spades_utils.py;
     # add templated report
 
-    def generate_report(self, console, warnings, fa_file_name, params, out_dir, wsname):
+    def generate_report(self, console, warnings, token, fa_file_name, params, out_dir, wsname,
+                        resources, scratch_usage, unicycler_log):
         """
         Generating and saving report
         """
         self.log(console, 'Generating and saving report')
 
         fa_file_with_path = os.path.join(out_dir, fa_file_name)
-        [length_stats, coverage_stats, circ_stats] = self.load_stats(console, fa_file_with_path)
-        lengths = [length_stats[contig_id] for contig_id in length_stats]
+
+        # saving the assembly, QUAST and zipping the output are independent,
+        # so run them alongside each other and the report rendering; the
+        # zip skips the files that are deleted below or added afterwards
+        stage_times = []
+        stage_pool = ThreadPoolExecutor(max_workers=3)
+        try:
+            save_job = stage_pool.submit(self.timed_stage, stage_times, 'assembly save',
+                                         self.save_assembly, console, token, params,
+                                         fa_file_with_path)
+            quast_job = stage_pool.submit(self.timed_stage, stage_times, 'QUAST',
+                                          self.run_quast, console, params, fa_file_with_path)
+            zip_job = stage_pool.submit(self.timed_stage, stage_times, 'zip',
+                                        self.generate_output_file_list, console, out_dir,
+                                        [os.path.relpath(fa_file_with_path, out_dir),
+                                         REPORT_FILE, CONTIG_DATA_FILE, QUAST_REPORT_FILE],
+                                        resources['threads'])
+            return self.finish_report(console, warnings, fa_file_with_path, params, out_dir,
+                                      wsname, resources, scratch_usage, unicycler_log,
+                                      save_job, quast_job, zip_job, stage_times)
+        finally:
+            stage_pool.shutdown(wait=True)
+
+    # the part of the report that runs alongside the post-assembly stages;
+    # joins them before creating the report
+    def finish_report(self, console, warnings, fa_file_with_path, params, out_dir, wsname,
+                      resources, scratch_usage, unicycler_log, save_job, quast_job, zip_job,
+                      stage_times):
+        contigs = self.load_stats(console, fa_file_with_path)
+        lengths = contigs['length']
 
         assembly_ref = wsname + '/' + params['output_contigset_name']
 
         report_text = ''
         report_text += 'Unicycler results saved to: ' + wsname + '/' + out_dir + '\n'
         report_text += 'Assembly saved to: ' + assembly_ref + '\n'
-        report_text += 'Assembled into ' + str(len(lengths)) + ' contigs.\n'
-        report_text += 'Avg Length: ' + str(sum(lengths) / float(len(lengths))) + ' bp.\n'
+        stats = assembly_stats(contigs)
+        report_text += 'Assembled into ' + str(stats['contigs']) + ' contigs.\n'
+        report_text += 'Avg Length: ' + str(stats['mean_length']) + ' bp.\n'
+        report_text += ('Total Length: ' + str(stats['total_length']) + ' bp; largest contig ' +
+                        str(stats['largest_contig']) + ' bp.\n')
+        report_text += ('N50: ' + str(stats['n50']) + ' bp (L50 ' + str(stats['l50']) +
+                        '); N90: ' + str(stats['n90']) + ' bp (L90 ' + str(stats['l90']) + ').\n')
+        report_text += 'GC: ' + '{:.2f}'.format(100 * stats['gc']) + '%.\n'
+        report_text += ('Circular: ' + str(stats['circular_contigs']) + ' contigs, ' +
+                        str(stats['circular_length']) + ' bp; linear: ' +
+                        str(stats['linear_contigs']) + ' contigs, ' +
+                        str(stats['linear_length']) + ' bp.\n')
+        report_text += ('Mean Relative Coverage: ' + '{:.2f}'.format(stats['mean_depth']) +
+                        'x; coverage-weighted avg length: ' +
+                        '{:.1f}'.format(stats['depth_weighted_length']) + ' bp.\n')
+        if resources['pilon_heap_gb'] is None:
+            pilon_heap = 'Pilon default heap'
+        else:
+            pilon_heap = 'Pilon -Xmx' + str(resources['pilon_heap_gb']) + 'G'
+        report_text += ('Resources: ' + str(resources['threads']) + ' threads, ' +
+                        str(resources['memory'] // (1 << 20)) + ' MB memory (SPAdes -m ' +
+                        str(resources['spades_memory_gb']) + ' GB, ' + pilon_heap + ').\n')
+        report_text += ('Peak scratch disk usage: ' + str(scratch_usage.peak // (1 << 20)) +
+                        ' MB (' + str(scratch_usage.peak_stage) + ').\n')
+        usage = resources.get('usage', {})
+        if usage.get('samples'):
+            report_text += ('Unicycler resource use: peak CPU ' +
+                            '{:.0f}'.format(usage['peak_cpu_percent']) + '% (mean ' +
+                            '{:.0f}'.format(usage['mean_cpu_percent']) + '%), peak memory ' +
+                            str(usage['peak_rss'] // (1 << 20)) + ' MB, peak open files ' +
+                            str(usage['peak_open_files']) + ', ' +
+                            str(usage['read_bytes'] // (1 << 20)) + ' MB read, ' +
+                            str(usage['write_bytes'] // (1 << 20)) + ' MB written (' +
+                            RESOURCE_USAGE_FILE + ').\n')
+        report_text += 'Unicycler phases: ' + ', '.join(
+            [phase + ' ' + '{:.1f}'.format(seconds) + ' s'
+             for phase, seconds in unicycler_log.phase_seconds()]) + '.\n'
 
         # compute a simple contig length distribution
         bins = 10
@@ -209,68 +325,68 @@ A wrapper for the unicycler assembler
         for c in range(bins):
             report_text += ('   ' + str(counts[c]) + '\t--\t' + str(edges[c]) + ' to ' +
                             str(edges[c + 1]) + ' bp\n')
-        self.log(console, 'Running QUAST')
-        kbq = kb_quast(self.callbackURL)
-        quastret = kbq.run_QUAST(
-            {'files': [{'path': fa_file_with_path, 'label': params['output_contigset_name']}]})
-        # self.log(console,'quastret = '+pformat(quastret))
-
-        # delete assembly file to keep it out of zip
-        os.remove(fa_file_with_path)
 
         # check starting genes
-        in_start = False
-        ic = iter(console)
-        for line in ic:
-            if line.startswith('Rotating completed replicons'):
-                while not line.startswith('Assembly complete'):
-                    line = next(ic)
-                    # self.log(console,'debug line = '+line)
-                    fields = line.strip().split()
-                    if len(fields) > 3 and fields[0] in circ_stats and circ_stats[fields[0]] == 'Y':
-                        if fields[3] == 'none':
-                            fields[3] = 'none found'
-                        circ_stats[fields[0]] = 'Y, '+fields[3]
+        circ_stats = dict()
+        for contig in contigs[contigs['circular']]:
+            contig_id = str(contig['id'])
+            circ_stats[contig_id] = 'Y'
+            if contig_id in unicycler_log.rotations:
+                circ_stats[contig_id] = 'Y, '+unicycler_log.rotations[contig_id]['starting_gene']
 
         # check circularization and make data table for report
         contig_data = []
-        for contig_id in length_stats:
+        for contig in contigs:
+            contig_id = str(contig['id'])
             contig_data.append({'contig_id': contig_id,
-                                'circular': circ_stats[contig_id],
-                                'coverage': coverage_stats[contig_id],
-                                'length': length_stats[contig_id]})
+                                'circular': circ_stats.get(contig_id, 'N'),
+                                'coverage': float(contig['depth']),
+                                'gc': round(100 * float(contig['gc']), 2),
+                                'length': int(contig['length'])})
 
         # self.log(console, 'contig_data = '+pformat(contig_data))
 
-        # move quast output into main out_dir
-        move(os.path.join(quastret['quast_path'], 'report.html'),
-             os.path.join(out_dir, 'quast_report.html'))
+        # move quast output into main out_dir, and into the zip
+        quastret = quast_job.result()
+        quast_report = os.path.join(out_dir, QUAST_REPORT_FILE)
+        move(os.path.join(quastret['quast_path'], 'report.html'), quast_report)
+        output_files = zip_job.result()
+        with zipfile.ZipFile(output_files[0]['path'], 'a', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as ziph:
+            ziph.write(quast_report, os.path.join(os.path.basename(out_dir),
+                                                  os.path.basename(quast_report)))
 
-        output_files = self.generate_output_file_list(console, out_dir)
+        # the contig table goes in its own file, loaded by the report page
+        with gzip.open(os.path.join(out_dir, CONTIG_DATA_FILE), 'wt') as f:
+            json.dump(contig_data, f)
 
         # render template
         template_file = 'unicycler_tabs.tt'
+        cols = [
+            {'data': 'contig_id',  'title': 'Contig ID'},
+            {'data': 'circular',   'title': 'Circular, Starting Gene'},
+            {'data': 'coverage',   'title': 'Relative Coverage (x)'},
+            {'data': 'gc',   'title': 'GC (%)'},
+            {'data': 'length',   'title': 'Length (bp)'}
+        ]
         tmpl_data = {
             'page_title': 'Unicycler Report',
-            'data_array': contig_data,
-            'cols': [
-                {'data': 'contig_id',  'title': 'Contig ID'},
-                {'data': 'circular',   'title': 'Circular, Starting Gene'},
-                {'data': 'coverage',   'title': 'Relative Coverage (x)'},
-                {'data': 'length',   'title': 'Length (bp)'}
-            ]
+            'cols': cols,
+            'cols_json': json.dumps(cols),
+            'contig_data_file': CONTIG_DATA_FILE
         }
         # tmpl_data['quast_output'] = '<iframe>'+self.read_html(os.path.join(quastret['quast_path'],'report.html'))+'</iframe>'
         # tmpl_data['quast_output'] = '<iframe frameborder="0" width="100%" height="100%" src="'+os.path.join(quastret['quast_path'],'report.html')+'"></iframe>'
-        tmpl_data['quast_output'] = '<iframe style="display:block; width:100%; height:100vh; border:none;" src="quast_report.html"></iframe>'
-        tmpl_data['tmpl_vars'] = json.dumps(tmpl_data, sort_keys=True, indent=2)
+        tmpl_data['quast_output'] = '<iframe style="display:block; width:100%; height:100vh; border:none;" src="' + QUAST_REPORT_FILE + '"></iframe>'
         tmpl_data['template_content'] = self.read_template(template_file)
-        tmpl_data['unicycler_log'] = '<p><pre>'+'<br>'.join(filter(lambda line: not (
-            line.startswith('tput') or line.lstrip().startswith('0 / ')), console))+'</pre></p>'
+        log_note = ''
+        if console.dropped() > 0:
+            log_note = ('<p>Showing the last ' + str(len(console)) + ' lines; the full log is in ' +
+                        CONSOLE_LOG_FILE + '.</p>')
+        tmpl_data['unicycler_log'] = log_note+'<p><pre>'+'<br>'.join(console)+'</pre></p>'
 
         # save report
         self.log(console, 'Saving report')
-        report_file = 'unicycler_report.html'
 
         # copy the templates into 'scratch', where they can be accessed by KBaseReport
         try:
@@ -285,16 +401,35 @@ A wrapper for the unicycler assembler
         template_output = reportClient.render_template({
             'template_file': os.path.join(self.scratch, 'templates', template_file),
             'template_data_json': json.dumps(tmpl_data),
-            'output_file': os.path.join(out_dir, report_file)
+            'output_file': os.path.join(out_dir, REPORT_FILE)
         })
 
+        # the assembly must be saved before the report can refer to it; the
+        # assembly file stays out of the report's html folder
+        save_job.result()
+        os.remove(fa_file_with_path)
+        # the SetAPI client has its own copy of the base client
+        retries = retry_counts()['retries'] + setapi_retry_counts()['retries']
+        if retries > 0:
+            report_text += 'Service calls retried after transient errors: ' + str(retries) + '.\n'
+        report_text += 'Post-assembly stages (run concurrently): ' + ', '.join(
+            [stage + ' ' + '{:.1f}'.format(seconds) + ' s'
+             for stage, seconds in stage_times]) + '.\n'
+
+        # the full log, up to here
+        console.close()
+        output_files.append({'path': console.path,
+                             'name': CONSOLE_LOG_FILE,
+                             'label': CONSOLE_LOG_FILE,
+                             'description': 'Full log of the Unicycler app'})
+
         report_output = reportClient.create_extended_report(
             {'message': report_text,
              'objects_created': [{'ref': assembly_ref, 'description': 'Assembled contigs'}],
              'direct_html_link_index': 0,
              'file_links': output_files,
              'html_links': [{'path': out_dir,
-                             'name': report_file,
+                             'name': REPORT_FILE,
                              'label': 'Unicycler report',
                              'description': 'description of template report'
                              }
@@ -305,93 +440,224 @@ A wrapper for the unicycler assembler
 
         return report_output['name'], report_output['ref']
 
-    # get short paired reads, and combine into forward and reverse files
-    def download_short_paired(self, console, token, wsname, short_paired_libraries):
+    # run func(*args), recording how long it took as (stage, seconds)
+    def timed_stage(self, stage_times, stage, func, *args):
+        start = time.time()
+        result = func(*args)
+        stage_times.append((stage, time.time() - start))
+        return result
+
+    def save_assembly(self, console, token, params, contigsPath):
+        self.log(console, 'Saving assembly')
+        try:
+            auClient = AssemblyUtil(url=self.callbackURL, token=token, service_ver='release')
+            auClient.save_assembly_from_fasta(
+                {'file': {'path': contigsPath},
+                 'workspace_name': params['workspace_name'],
+                 'assembly_name': params['output_contigset_name']})
+        except Exception as e:
+            raise ValueError('Error saving assembly\n' + str(e))
+
+    def run_quast(self, console, params, fa_file_with_path):
+        self.log(console, 'Running QUAST')
+        kbq = kb_quast(self.callbackURL)
+        return kbq.run_QUAST(
+            {'files': [{'path': fa_file_with_path, 'label': params['output_contigset_name']}]})
+
+    # resolve and type-check all input libraries with a single workspace
+    # call, so bad refs fail before any reads are downloaded.
+    # libraries is a list of (name or ref, list of valid types); returns a
+    # list of dicts with the versioned 'ref', the unversioned 'type' and the
+    # object 'info' (with metadata), in the same order
+    def resolve_libraries(self, console, token, wsname, libraries):
+        if len(libraries) == 0:
+            return []
         try:
-            ruClient = ReadsUtils(url=self.callbackURL, token=token)
+            wsClient = CachedWorkspace(Workspace(self.workspaceURL, token=token),
+                                       self.refCache, token)
+        except Exception as e:
+            raise ValueError("unable to instantiate wsClient. "+str(e))
 
-            # first, unpack any ReadsSets into the actual PairedEndLibrary referencs
-            reads_refs = []
-            # object info
+        obj_ids = [{'ref': lib if '/' in lib else (wsname + '/' + lib)}
+                   for lib, valid_types in libraries]
+        self.log(console, 'Resolving '+str(len(obj_ids))+' input libraries')
+        try:
+            infos = wsClient.get_object_info3({'objects': obj_ids,
+                                               'includeMetadata': 1,
+                                               'ignoreErrors': 1})['infos']
+        except Exception as e:
+            raise ValueError('Unable to get input library info\n' + str(e))
+
+        resolved = []
+        errors = []
+        for (lib, valid_types), lib_obj_info in zip(libraries, infos):
+            if lib_obj_info is None:
+                errors.append('Unable to get read library object: (' + str(lib) + ')')
+                continue
+            # remove trailing version
+            lib_obj_type = re.sub('-[0-9]+\.[0-9]+$', "", lib_obj_info[TYPE_I])
+            if lib_obj_type not in valid_types:
+                errors.append('Library ' + str(lib) + ' has unsupported type ' +
+                              lib_obj_type)
+                continue
+            lib_ref = str(lib_obj_info[WSID_I])+'/' + \
+                str(lib_obj_info[OBJID_I])+'/'+str(lib_obj_info[VERSION_I])
+            resolved.append({'ref': lib_ref,
+                             'type': lib_obj_type,
+                             'info': lib_obj_info})
+        if len(errors) > 0:
+            raise ValueError('\n'.join(errors))
+        return resolved
+
+    # expand ReadsSets into the actual reads library refs.  library_groups
+    # is a list of lists of resolved libraries; returns a list of lists of
+    # reads refs, in input order with nested sets flattened and duplicates
+    # removed within each group.  All sets are fetched concurrently through
+    # one SetAPI client.
+    def expand_reads_sets(self, console, token, library_groups):
+        set_items = dict()
+
+        def get_set_items(set_ref):
+            self.log(console, 'getting reads set '+set_ref)
             try:
-                wsClient = Workspace(self.workspaceURL, token=token)
+                readsSet = setAPIClient.get_reads_set_v1(
+                    {'ref': set_ref, 'include_item_info': 1})
             except Exception as e:
-                raise ValueError("unable to instantiate wsClient. "+str(e))
-
-            [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I,
-                WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
-            for lib in short_paired_libraries:
-                try:
-                    obj_id = {'ref': lib if '/' in lib else (wsname + '/' + lib)}
-                    lib_obj_info = wsClient.get_object_info_new({'objects': [obj_id]})[0]
-                    lib_obj_type = lib_obj_info[TYPE_I]
-                    # remove trailing version
-                    lib_obj_type = re.sub('-[0-9]+\.[0-9]+$', "", lib_obj_type)
-                    lib_ref = str(lib_obj_info[WSID_I])+'/' + \
-                        str(lib_obj_info[OBJID_I])+'/'+str(lib_obj_info[VERSION_I])
-                    if lib_obj_type == 'KBaseSets.ReadsSet':
-                        # unpack it
-                        try:
-                            setAPIClient = SetAPI(url=self.serviceWizardURL, token=token)
-                            self.log(console, 'getting reads set '+lib_ref)
-                            readsSet = setAPIClient.get_reads_set_v1(
-                                {'ref': lib_ref, 'include_item_info': 1})
-                        except Exception as e:
-                            raise ValueError(
-                                'SetAPI FAILURE: Unable to get read library set object: (' + lib_ref + ')\n' + str(e))
-                        for readsLibrary in readsSet['data']['items']:
-                            reads_refs.append(readsLibrary['ref'])
-                    else:
-                        # use other reads objects "as is"
-                        reads_refs.append(lib_ref)
-                except Exception as e:
-                    raise ValueError(
-                        'Unable to get read library object: (' + str(lib) + ')' + str(e))
-
-            # download all reads refs in one call, in separate files
-            self.log(console, "Getting short paired end reads.\n")
-            result = ruClient.download_reads({'read_libraries': reads_refs,
-                                              'interleaved': 'false'})
-
-            # combine outputs
-            short_fwd_path = os.path.join(self.scratch, "short_fwd_"+str(uuid.uuid4())+".fastq")
-            short_rev_path = os.path.join(self.scratch, "short_rev_"+str(uuid.uuid4())+".fastq")
-            self.log(console, "Combining short paired end reads.\n")
-
-            for reads_ref in reads_refs:
+                raise ValueError('SetAPI FAILURE: Unable to get read library set object: (' +
+                                 set_ref + ')\n' + str(e))
+            items = []
+            for readsLibrary in readsSet['data']['items']:
+                item_type = None
+                if readsLibrary.get('info') is not None:
+                    item_type = re.sub('-[0-9]+\.[0-9]+$', "", readsLibrary['info'][TYPE_I])
+                items.append((readsLibrary['ref'], item_type))
+            return items
+
+        pending = [lib['ref'] for group in library_groups for lib in group
+                   if lib['type'] == READS_SET_TYPE]
+        if len(pending) > 0:
+            setAPIClient = CachedSetAPI(SetAPI(url=self.serviceWizardURL, token=token),
+                                        self.refCache, token)
+            with ThreadPoolExecutor(max_workers=MAX_SET_WORKERS) as pool:
+                # fetch one level of nesting per round
+                while len(pending) > 0:
+                    pending = [ref for ref in dict.fromkeys(pending) if ref not in set_items]
+                    results = list(pool.map(get_set_items, pending))
+                    for set_ref, items in zip(pending, results):
+                        set_items[set_ref] = items
+                    pending = [ref for items in results for ref, item_type in items
+                               if item_type == READS_SET_TYPE]
+
+        reads_ref_groups = []
+        for group in library_groups:
+            reads_refs = []
+            seen = set()
+            duplicates = []
+
+            def add(ref, ref_type):
+                if ref in seen:
+                    if ref_type != READS_SET_TYPE:
+                        duplicates.append(ref)
+                    return
+                seen.add(ref)
+                if ref_type == READS_SET_TYPE:
+                    for item_ref, item_type in set_items[ref]:
+                        add(item_ref, item_type)
+                else:
+                    reads_refs.append(ref)
+
+            for lib in group:
+                add(lib['ref'], lib['type'])
+            if len(duplicates) > 0:
+                self.log(console, 'Skipping duplicate reads libraries: '+', '.join(duplicates))
+            reads_ref_groups.append(reads_refs)
+        return reads_ref_groups
+
+    # look up a reads library in the reads cache, if there is one; returns
+    # the ReadsUtils-style files dict, or None.  Cache problems never fail
+    # the job, they just mean a download.
+    def get_cached_reads(self, console, reads_ref):
+        if self.readsCache is None:
+            return None
+        try:
+            files = self.readsCache.get(reads_ref, self.scratch)
+        except Exception as e:
+            self.log(console, 'Reads cache lookup failed for '+reads_ref+': '+str(e))
+            return None
+        if files is not None:
+            self.log(console, 'Reads cache hit for '+reads_ref)
+        return files
+
+    def put_cached_reads(self, console, reads_ref, files):
+        if self.readsCache is None:
+            return
+        try:
+            self.readsCache.put(reads_ref, {key: files[key] for key in ('fwd', 'rev')
+                                            if key in files})
+        except Exception as e:
+            self.log(console, 'Unable to cache reads for '+reads_ref+': '+str(e))
+
+    # download reads libraries one at a time, a few at once, and append each
+    # to the combined files as soon as it (and every library before it) has
+    # landed, so downloading and combining overlap.  combiners maps the
+    # ReadsUtils file key ('fwd', 'rev') to a Combiner.
+    def download_and_combine(self, console, token, reads_refs, combiners, scratch_usage):
+        ruClient = ReadsUtils(url=self.callbackURL, token=token)
+        read_names = {'fwd': 'forward', 'rev': 'reverse'}
+
+        def download(reads_ref):
+            start = time.time()
+            files = self.get_cached_reads(console, reads_ref)
+            if files is None:
+                result = ruClient.download_reads({'read_libraries': [reads_ref],
+                                                  'interleaved': 'false'})
                 files = result['files'][reads_ref]['files']
+                self.put_cached_reads(console, reads_ref, files)
+            return files, time.time() - start
+
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as download_pool, \
+                ThreadPoolExecutor(max_workers=len(combiners)) as combine_pool:
+            # keep a bounded number of downloads in flight, so finished
+            # downloads can't pile up in scratch ahead of the combiner
+            pending = deque()
+            next_ref = 0
+            while next_ref < len(reads_refs) or len(pending) > 0:
+                while next_ref < len(reads_refs) and len(pending) < MAX_DOWNLOAD_WORKERS:
+                    pending.append((reads_refs[next_ref],
+                                    download_pool.submit(download, reads_refs[next_ref])))
+                    next_ref += 1
+                reads_ref, downloaded = pending.popleft()
+                files, download_time = downloaded.result()
                 self.log(console, 'files = '+pformat(files))
+                scratch_usage.sample('downloaded '+reads_ref)
+                for key in combiners:
+                    if key not in files:
+                        raise ValueError('File '+reads_ref+' missing '+read_names[key] +
+                                         ' reads file')
+                start = time.time()
+                appends = [combine_pool.submit(combiners[key].append, files[key])
+                           for key in combiners]
+                for append in appends:
+                    append.result()
+                self.log(console, 'library {}: downloaded in {:.1f} s, combined in {:.1f} s'.format(
+                    reads_ref, download_time, time.time() - start))
 
-                if 'fwd' in files:
-                    path = files['fwd']
-                    if path.endswith('.gz'):
-                        cmd = 'gzip -dc '+path+' >> '+short_fwd_path
-                    else:
-                        cmd = 'cat '+path+' >> '+short_fwd_path
-                    self.log(console, "command: "+cmd)
-                    cmdProcess = subprocess.Popen(
-                        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-                    cmdProcess.wait()
-                    if cmdProcess.returncode != 0:
-                        raise ValueError('Error running '+cmd)
-                    os.remove(path)
-                else:
-                    raise ValueError('File '+reads_ref+' missing forward reads file')
-                if 'rev' in files:
-                    path = files['rev']
-                    if path.endswith('.gz'):
-                        cmd = 'gzip -dc '+path+' >> '+short_rev_path
-                    else:
-                        cmd = 'cat '+path+' >> '+short_rev_path
-                    self.log(console, "command: "+cmd)
-                    cmdProcess = subprocess.Popen(
-                        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-                    cmdProcess.wait()
-                    if cmdProcess.returncode != 0:
-                        raise ValueError('Error running '+cmd)
-                    os.remove(path)
-                else:
-                    raise ValueError('File '+reads_ref+' missing reverse reads file')
+    # get short paired reads, and combine into forward and reverse files
+    def download_short_paired(self, console, token, reads_refs, scratch_usage):
+        try:
+            # unicycler and SPAdes read gzip directly, so keep reads compressed
+            short_fwd_path = os.path.join(
+                self.scratch, "short_fwd_"+str(uuid.uuid4())+".fastq.gz")
+            short_rev_path = os.path.join(
+                self.scratch, "short_rev_"+str(uuid.uuid4())+".fastq.gz")
+
+            self.log(console, "Getting and combining short paired end reads.\n")
+            with Combiner(short_fwd_path, compress=True) as fwd, \
+                    Combiner(short_rev_path, compress=True) as rev:
+                self.download_and_combine(console, token, reads_refs,
+                                          {'fwd': fwd, 'rev': rev}, scratch_usage)
+                self.log(console, 'combined '+str(fwd.size())+' B of compressed forward reads, ' +
+                         str(rev.size())+' B of compressed reverse reads')
 
         except Exception as e:
             raise ValueError('Unable to download short paired reads\n' + str(e))
@@ -399,146 +665,142 @@ A wrapper for the unicycler assembler
         return short_fwd_path, short_rev_path
 
     # get short unpaired reads, and combine into one file
-    def download_short_unpaired(self, console, token, wsname, short_unpaired_libraries):
+    def download_short_unpaired(self, console, token, reads_refs, scratch_usage):
         try:
-            self.log(console, "Getting short unpaired reads.\n")
-            ruClient = ReadsUtils(url=self.callbackURL, token=token)
-
-            # first, unpack any ReadsSets into the actual SingleEndLibrary referencs
-            reads_refs = []
-            # object info
-            try:
-                wsClient = Workspace(self.workspaceURL, token=token)
-            except Exception as e:
-                raise ValueError("unable to instantiate wsClient. "+str(e))
-
-            [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I,
-                WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
-            for lib in short_unpaired_libraries:
-                try:
-                    obj_id = {'ref': lib if '/' in lib else (wsname + '/' + lib)}
-                    lib_obj_info = wsClient.get_object_info_new({'objects': [obj_id]})[0]
-                    lib_obj_type = lib_obj_info[TYPE_I]
-                    # remove trailing version
-                    lib_obj_type = re.sub('-[0-9]+\.[0-9]+$', "", lib_obj_type)
-                    lib_ref = str(lib_obj_info[WSID_I])+'/' + \
-                        str(lib_obj_info[OBJID_I])+'/'+str(lib_obj_info[VERSION_I])
-                    if lib_obj_type == 'KBaseSets.ReadsSet':
-                        # unpack it
-                        try:
-                            setAPIClient = SetAPI(url=self.serviceWizardURL, token=token)
-                            self.log(console, 'getting reads set '+lib_ref)
-                            readsSet = setAPIClient.get_reads_set_v1(
-                                {'ref': lib_ref, 'include_item_info': 1})
-                        except Exception as e:
-                            raise ValueError(
-                                'SetAPI FAILURE: Unable to get read library set object: (' + lib_ref + ')\n' + str(e))
-                        for readsLibrary in readsSet['data']['items']:
-                            reads_refs.append(readsLibrary['ref'])
-                    else:
-                        # use other reads objects "as is"
-                        reads_refs.append(lib_ref)
-                except Exception as e:
-                    raise ValueError(
-                        'Unable to get read library object: (' + str(lib) + ')' + str(e))
-
-            result = ruClient.download_reads({'read_libraries': reads_refs,
-                                              'interleaved': 'false'})
-            # combine outputs
             short_unpaired_path = os.path.join(
-                self.scratch, "short_unpaired_"+str(uuid.uuid4())+".fastq")
-
-            self.log(console, "Combining short unpaired reads.\n")
-
-            for reads_ref in reads_refs:
-                files = result['files'][reads_ref]['files']
+                self.scratch, "short_unpaired_"+str(uuid.uuid4())+".fastq.gz")
 
-                if 'fwd' in files:
-                    path = files['fwd']
-                    if path.endswith('.gz'):
-                        cmd = 'gzip -dc '+path+' >> '+short_unpaired_path
-                    else:
-                        cmd = 'cat '+path+' >> '+short_unpaired_path
-                    self.log(console, "command: "+cmd)
-                    cmdProcess = subprocess.Popen(
-                        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-                    cmdProcess.wait()
-                    if cmdProcess.returncode != 0:
-                        raise ValueError('Error running '+cmd)
-                    os.remove(path)
-                else:
-                    raise ValueError('File '+reads_ref+' missing forward reads file')
+            self.log(console, "Getting and combining short unpaired reads.\n")
+            with Combiner(short_unpaired_path, compress=True) as unpaired:
+                self.download_and_combine(console, token, reads_refs,
+                                          {'fwd': unpaired}, scratch_usage)
+                self.log(console, 'combined '+str(unpaired.size()) +
+                         ' B of compressed unpaired reads')
 
         except Exception as e:
             raise ValueError('Unable to download short unpaired reads\n' + str(e))
         return short_unpaired_path
 
-    # get long reads
-    def download_long(self, console, warnings, token, wsname, lib, min_long_read_length):
+    # estimate the size of the long reads from the workspace metadata of
+    # the resolved library, and decide before downloading anything whether
+    # to go ahead, filter them down after download, or give up.  Returns
+    # 'proceed', 'subsample' or 'unknown' (no usable metadata), or raises
+    # for oversized input.  This is only an estimate: download_long filters
+    # the reads whenever their measured size is over the limit.
+    def check_long_reads_size(self, console, warnings, lib):
+        meta = lib['info'][META_I] or {}
+        total_bases = None
         try:
-            # object info
-            try:
-                wsClient = Workspace(self.workspaceURL, token=token)
-            except Exception as e:
-                raise ValueError("unable to instantiate wsClient. "+str(e))
-
-            [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I,
-                WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
+            for key in ('total_bases', 'Size'):
+                if meta.get(key) not in (None, ''):
+                    total_bases = int(float(meta[key]))
+                    break
+            if total_bases is None and meta.get('read_count') and meta.get('read_length_mean'):
+                total_bases = int(float(meta['read_count']) * float(meta['read_length_mean']))
+        except (ValueError, TypeError, OverflowError):
+            # metadata is free text; NaN and inf give ValueError and OverflowError
+            total_bases = None
+        if total_bases is None:
+            self.log(console, 'No usable size metadata for long reads '+lib['ref'] +
+                     '; checking after download')
+            return 'unknown'
+        self.log(console, 'Long reads '+lib['ref']+' have about '+str(total_bases)+' bases')
+        if total_bases > MAX_LONG_READ_DOWNLOAD_BASES:
+            raise ValueError('Too many long reads; total length is limited to 1 GB and you have ' +
+                             str(total_bases)+' B, too many to filter here.  Use filtlong app ' +
+                             'to filter out lower quality reads.')
+        if total_bases > MAX_LONG_READ_BASES:
+            self.log(warnings, 'Warning:  Long reads have about '+str(total_bases) +
+                     ' bases; they will be filtered down to '+str(MAX_LONG_READ_BASES)+' bases.')
+            return 'subsample'
+        return 'proceed'
 
-            obj_id = {'ref': lib if '/' in lib else (wsname + '/' + lib)}
-            lib_obj_info = wsClient.get_object_info_new({'objects': [obj_id]})[0]
-            lib_obj_type = lib_obj_info[TYPE_I]
-            lib_obj_type = re.sub('-[0-9]+\.[0-9]+$', "", lib_obj_type)  # remove trailing version
-            lib_ref = str(lib_obj_info[WSID_I])+'/' + \
-                str(lib_obj_info[OBJID_I])+'/'+str(lib_obj_info[VERSION_I])
-            total_read_length = 0
-            if lib_obj_type == 'KBaseGenomes.ContigSet' or lib_obj_type == 'KBaseGenomeAnnotations.Assembly':
+    # get long reads
+    def download_long(self, console, warnings, token, lib, min_long_read_length,
+                      scratch_usage, size_check='unknown'):
+        try:
+            lib_obj_type = lib['type']
+            lib_ref = lib['ref']
+            is_fasta = lib_obj_type in ('KBaseGenomes.ContigSet',
+                                        'KBaseGenomeAnnotations.Assembly')
+            if is_fasta:
                 # download using assembly util / data file util
                 self.log(console, "Getting long reads (from contigs object).\n")
                 auClient = AssemblyUtil(url=self.callbackURL, token=token)
                 dfuClient = DataFileUtil(url=self.callbackURL, token=token)
                 contig_file = auClient.get_assembly_as_fasta({'ref': lib_ref}).get('path')
                 long_reads_path = dfuClient.unpack_file({'file_path': contig_file})['file_path']
-                self.log(
-                    warnings, "Warning:  Long reads are in FASTA format, so short read check was not performed.")
-
             else:
                 ruClient = ReadsUtils(url=self.callbackURL, token=token)
                 self.log(console, "Getting long reads (from reads library object).\n")
                 result = ruClient.download_reads({'read_libraries': [lib_ref],
                                                   'interleaved': 'false'})
                 long_reads_path = result['files'][lib_ref]['files']['fwd']
-                [n_reads, n_reads_short, total_read_length] = self.filter_short_fastq(
-                    console, long_reads_path, min_long_read_length)
+            scratch_usage.sample('long reads downloaded')
 
-                if (n_reads_short > 0):
-                    self.log(warnings, "Warning:  Of "+str(n_reads)+" long reads, "+str(n_reads_short)+" are shorter than " +
-                             str(min_long_read_length)+"; consider using the filtlong app to filter out shorter reads.")
+            [n_reads, n_reads_short, total_read_length] = self.filter_short_reads(
+                console, long_reads_path, min_long_read_length, is_fasta)
+
+            if (n_reads_short > 0):
+                self.log(warnings, "Warning:  Of "+str(n_reads)+" long reads, " +
+                         str(n_reads_short)+" are shorter than "+str(min_long_read_length) +
+                         "; consider using the filtlong app to filter out shorter reads.")
+
+            # the measured total decides; the metadata estimate can be low
+            if total_read_length > MAX_LONG_READ_BASES:
+                if size_check == 'proceed':
+                    self.log(console, 'Long reads metadata underestimated their size; ' +
+                             'filtering them after all')
+                long_reads_path, total_read_length = self.fit_long_reads(
+                    console, warnings, long_reads_path, MAX_LONG_READ_BASES, is_fasta)
 
         except Exception as e:
             raise ValueError('Unable to download long reads\n' + str(e))
-        if (total_read_length > 1000000000):
+        if (total_read_length > MAX_LONG_READ_BASES):
             raise ValueError('Too many long reads; total length is limited to 1 GB and you have '+str(total_read_length)+' B.  Use filtlong app to filter out lower quality reads.')
         return long_reads_path
 
-    # examine fastq files, count total read length
-    def filter_short_fastq(self, console, fastq_path, min_length):
-        n_reads = 0
-        n_reads_short = 0
-        total_read_length = 0
-        with open(fastq_path, 'r') as input_file_handle:
-            for current_line in input_file_handle:
-                if (current_line[0] == '@'):
-                    # self.log(console, 'fastq header = '+current_line)
-                    n_reads += 1
-                    seq = next(input_file_handle)
-                    if len(seq) < min_length:
-                        n_reads_short += 1
-                    total_read_length += len(seq)
-                    next(input_file_handle)
-                    next(input_file_handle)
-            self.log(console, str(n_reads)+' long reads found, ' +
-                     str(n_reads_short)+' under '+str(min_length)+' bp')
+    # keep the best long reads (most expected correct bases, so long and
+    # high quality; just long for FASTA) that fit in max_bases, instead of
+    # failing the job; returns the path of the filtered reads and their
+    # total length
+    def fit_long_reads(self, console, warnings, reads_path, max_bases, is_fasta=False):
+        self.log(console, 'Filtering long reads down to '+str(max_bases)+' bases')
+        if is_fasta:
+            lengths = fasta_record_lengths(reads_path)
+            keep = select_reads(lengths, np.ones(len(lengths)), max_bases)
+            filtered_path = os.path.join(self.scratch, "long_filtered_"+str(uuid.uuid4())+".fasta")
+            write_fasta_subset(reads_path, keep, filtered_path)
+            criteria = 'length'
+        else:
+            lengths, accuracies = fastq_read_stats(reads_path)
+            keep = select_reads(lengths, accuracies, max_bases)
+            filtered_path = os.path.join(self.scratch, "long_filtered_"+str(uuid.uuid4())+".fastq")
+            write_fastq_subset(reads_path, keep, filtered_path)
+            criteria = 'length and mean quality'
+        os.remove(reads_path)
+
+        kept_bases = int(lengths[keep].sum())
+        dropped = ~keep
+        self.log(warnings, "Warning:  Long reads total "+str(int(lengths.sum())) +
+                 " bases, over the limit of "+str(max_bases)+"; kept the best " +
+                 str(int(keep.sum()))+" of "+str(len(lengths))+" reads ("+str(kept_bases) +
+                 " bases) by "+criteria+", and dropped "+str(int(dropped.sum())) +
+                 " reads ("+str(int(lengths[dropped].sum()))+" bases, up to " +
+                 str(int(lengths[dropped].max()) if dropped.any() else 0)+" bp long).")
+        return filtered_path, kept_bases
+
+    # examine fastq or fasta files, count total read length
+    def filter_short_reads(self, console, reads_path, min_length, is_fasta=False):
+        if is_fasta:
+            lengths = fasta_record_lengths(reads_path)
+        else:
+            lengths = fastq_read_lengths(reads_path)
+        n_reads = len(lengths)
+        n_reads_short = int(np.count_nonzero(lengths < min_length))
+        total_read_length = int(lengths.sum())
+        self.log(console, str(n_reads)+' long reads found, ' +
+                 str(n_reads_short)+' under '+str(min_length)+' bp')
         return [n_reads, n_reads_short, total_read_length]
 
     #END_CLASS_HEADER
@@ -558,6 +820,14 @@ A wrapper for the unicycler assembler
         if not os.path.exists(self.scratch):
             os.makedirs(self.scratch)
         self.appdir = os.path.abspath(config['appdir'])
+        self.readsCache = None
+        if config.get('reads-cache-dir'):
+            cache_gb = float(config.get('reads-cache-size-gb') or DEFAULT_READS_CACHE_GB)
+            self.readsCache = ReadsCache(config['reads-cache-dir'], int(cache_gb * (1 << 30)))
+        self.sampleSeconds = float(config.get('resource-sample-seconds') or
+                                   DEFAULT_SAMPLE_SECONDS)
+        # workspace responses for versioned refs, which never change
+        self.refCache = RefCache(cache_dir=config.get('ref-cache-dir') or None)
         #END_CONSTRUCTOR
         pass
 
@@ -574,7 +844,7 @@ A wrapper for the unicycler assembler
            libraries short_unpaired_libraries - a list of short, paired end
            reads libraries long_reads_libraries - a list of long reads
            @optional min_contig_length @optional num_linear_seqs @optional
-           bridging_mode) -> structure: parameter "workspace_name" of String,
+           bridging_mode @optional threads) -> structure: parameter "workspace_name" of String,
            parameter "output_contigset_name" of String, parameter
            "short_paired_libraries" of list of type "paired_lib" (The
            workspace object name of a PairedEndLibrary file, whether of the
@@ -583,7 +853,8 @@ A wrapper for the unicycler assembler
            workspace object name of a SingleEndLibrary file, whether of the
            KBaseAssembly or KBaseFile type.), parameter "long_reads_library"
            of String, parameter "min_contig_length" of Long, parameter
-           "num_linear_seqs" of Long, parameter "bridging_mode" of String
+           "num_linear_seqs" of Long, parameter "bridging_mode" of String,
+           parameter "threads" of Long
         :returns: instance of type "UnicyclerOutput" (Output parameters for
            Unicycler run. report_name - the name of the KBaseReport.Report
            workspace object. report_ref - the workspace reference of the
@@ -593,7 +864,7 @@ A wrapper for the unicycler assembler
         # ctx is the context object
         # return variables are: output
         #BEGIN run_unicycler
-        console = []
+        console = ConsoleLog(os.path.join(self.scratch, str(uuid.uuid4()) + '_' + CONSOLE_LOG_FILE))
         warnings = []
         self.log(console, 'Running run_unicycler with params:\n{}'.format(
             json.dumps(params, indent=1)))
@@ -627,25 +898,57 @@ A wrapper for the unicycler assembler
         if 'long_reads_library' in params and params['long_reads_library'] is not None:
             provenance[0]['input_ws_objects'].append(params['long_reads_library'])
 
+        # look up and check all inputs before downloading anything
+        short_paired_libraries = []
+        short_unpaired_libraries = []
+        long_reads_library = None
+        if 'short_paired_libraries' in params and params['short_paired_libraries'] is not None:
+            short_paired_libraries = params['short_paired_libraries']
+        if 'short_unpaired_libraries' in params and params['short_unpaired_libraries'] is not None:
+            short_unpaired_libraries = params['short_unpaired_libraries']
+        if 'long_reads_library' in params and params['long_reads_library'] is not None:
+            long_reads_library = params['long_reads_library']
+        libraries = [(lib, PAIRED_TYPES) for lib in short_paired_libraries] + \
+            [(lib, UNPAIRED_TYPES) for lib in short_unpaired_libraries]
+        if long_reads_library is not None:
+            libraries.append((long_reads_library, LONG_TYPES))
+        resolved = self.resolve_libraries(console, token, params['workspace_name'], libraries)
+        n_paired = len(short_paired_libraries)
+        n_unpaired = len(short_unpaired_libraries)
+        long_size_check = None
+        if long_reads_library is not None:
+            long_size_check = self.check_long_reads_size(console, warnings, resolved[-1])
+
         # build command line
         cmd = 'unicycler'
 
+        # merged reads are written out in full rather than streamed through
+        # FIFOs: unicycler insists on regular input files, SPAdes and bowtie2
+        # (for Pilon) re-read the short reads, and Racon re-reads the long
+        # reads.  Per-library downloads are removed as they are combined.
+        scratch_usage = ScratchUsage(self.scratch)
+
+        # unpack any ReadsSets into the actual reads library refs
+        paired_refs, unpaired_refs = self.expand_reads_sets(
+            console, token, [resolved[:n_paired], resolved[n_paired:n_paired+n_unpaired]])
+
         # download, split, and recombine short paired libraries
-        if 'short_paired_libraries' in params and params['short_paired_libraries'] is not None and len(params['short_paired_libraries']) > 0:
+        if n_paired > 0:
             short1, short2 = self.download_short_paired(
-                console, token, params['workspace_name'], params['short_paired_libraries'])
+                console, token, paired_refs, scratch_usage)
             cmd += ' -1 '+short1+' -2 '+short2
 
         # download and combine short unpaired libraries
-        if 'short_unpaired_libraries' in params and params['short_unpaired_libraries'] is not None and len(params['short_unpaired_libraries']) > 0:
+        if n_unpaired > 0:
             unpaired = self.download_short_unpaired(
-                console, token, params['workspace_name'], params['short_unpaired_libraries'])
+                console, token, unpaired_refs, scratch_usage)
             cmd += ' -s '+unpaired
 
         # download long library
-        if 'long_reads_library' in params and params['long_reads_library'] is not None:
+        if long_reads_library is not None:
             longLib = self.download_long(
-                console, warnings, token, params['workspace_name'], params['long_reads_library'], params['min_long_read_length'])
+                console, warnings, token, resolved[-1], params['min_long_read_length'],
+                scratch_usage, long_size_check)
             cmd += ' -l '+longLib
 
         # other params
@@ -653,6 +956,21 @@ A wrapper for the unicycler assembler
         cmd += ' --linear_seqs '+str(params['num_linear_seqs'])
         cmd += ' --mode '+str(params['bridging_mode'])
         cmd += ' --keep 0'
+        # unicycler hands the same thread count to SPAdes, Racon and the
+        # bowtie2/samtools steps of Pilon polishing
+        resources = {'threads': self.get_thread_count(console, params)}
+        cmd += ' --threads '+str(resources['threads'])
+
+        # SPAdes and Pilon run one after the other, so each gets most of
+        # the memory
+        resources.update(self.get_memory_caps(console))
+        cmd += ' --spades_options "-m '+str(resources['spades_memory_gb'])+'"'
+        pilon_path = self.write_pilon_wrapper(console, resources['pilon_heap_gb'])
+        if pilon_path is not None:
+            cmd += ' --pilon_path '+pilon_path
+        else:
+            # the image's pilon runs with its own fixed heap
+            resources['pilon_heap_gb'] = None
 
         if ('no_correct' in params and (params['no_correct'] == 1)):
             cmd += ' --no_correct'
@@ -663,29 +981,36 @@ A wrapper for the unicycler assembler
         cmd += ' -o '+outputDir
 
         # run it
+        scratch_usage.sample('reads combined')
         self.log(console, "command: "+cmd)
         cmdProcess = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                       stderr=subprocess.STDOUT, shell=True)
-        for line in cmdProcess.stdout:
-            self.log(console, line.decode("utf-8").rstrip())
-        cmdProcess.wait()
+        # sample the whole process tree (SPAdes, Racon, Pilon...) as it runs
+        sampler = ProcessSampler(cmdProcess.pid, self.sampleSeconds, scratch_usage,
+                                 'unicycler running')
+        sampler.start()
+        unicycler_log = UnicyclerLogParser()
+        try:
+            for line in cmdProcess.stdout:
+                line = line.decode("utf-8").rstrip()
+                unicycler_log.feed(line)
+                self.log(console, line)
+            cmdProcess.wait()
+        finally:
+            # don't leave the sampling thread running if reading the output fails
+            sampler.stop()
+        unicycler_log.finish()
+        sampler.write_csv(os.path.join(outputDir, RESOURCE_USAGE_FILE))
+        resources['usage'] = sampler.summary()
         if cmdProcess.returncode != 0:
             raise ValueError('Error running '+cmd)
+        scratch_usage.sample('unicycler finished')
 
-        # save assembly
-        try:
-            contigsPath = os.path.join(outputDir, 'assembly.fasta')
-            auClient = AssemblyUtil(url=self.callbackURL, token=token, service_ver='release')
-            auClient.save_assembly_from_fasta(
-                {'file': {'path': contigsPath},
-                 'workspace_name': params['workspace_name'],
-                 'assembly_name': params['output_contigset_name']})
-        except Exception as e:
-            raise ValueError('Error saving assembly\n' + str(e))
-
-        # make report
+        # save assembly and make report
+        contigsPath = os.path.join(outputDir, 'assembly.fasta')
         report_name, report_ref = self.generate_report(
-            console, warnings, contigsPath, params, outputDir, params['workspace_name'])
+            console, warnings, token, contigsPath, params, outputDir, params['workspace_name'],
+            resources, scratch_usage, unicycler_log)
         output = {'report_name': report_name,
                   'report_ref': report_ref}
 
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+def nx(sorted_lengths, cumulative, target):
+    """
+    nx: (Nx, Lx) for lengths sorted longest first, their running total, and
+    a target number of bases; (0, 0) if the contigs never reach the target
+    """
+    i = int(np.searchsorted(cumulative, target))
+    if i >= len(sorted_lengths) or target <= 0:
+        return 0, 0
+    return int(sorted_lengths[i]), i + 1
+
+
+def assembly_stats(contigs, genome_size=None):
+    """
+    assembly_stats: summary statistics for a contig table from
+    seqscan.index_fasta: counts and totals (overall, circular and linear),
+    largest contig, N50/L50 and N90/L90, NG50/LG50 if genome_size is given,
+    overall GC fraction and depth-weighted lengths.  Returns a dict.
+    """
+    lengths = contigs['length'].astype(np.int64)
+    depths = contigs['depth']
+    circular = contigs['circular']
+    total = int(lengths.sum())
+
+    sorted_lengths = np.sort(lengths)[::-1]
+    cumulative = np.cumsum(sorted_lengths)
+    n50, l50 = nx(sorted_lengths, cumulative, total * 0.5)
+    n90, l90 = nx(sorted_lengths, cumulative, total * 0.9)
+
+    gc_bases = float(np.dot(contigs['gc'], lengths))
+    depth_bases = float(np.dot(depths, lengths))
+    depth_sum = float(depths.sum())
+
+    stats = {'contigs': len(lengths),
+             'total_length': total,
+             'largest_contig': int(sorted_lengths[0]) if len(lengths) else 0,
+             'mean_length': total / float(len(lengths)) if len(lengths) else 0.0,
+             'n50': n50, 'l50': l50,
+             'n90': n90, 'l90': l90,
+             'gc': gc_bases / total if total else 0.0,
+             'circular_contigs': int(np.count_nonzero(circular)),
+             'circular_length': int(lengths[circular].sum()),
+             'linear_contigs': int(np.count_nonzero(~circular)),
+             'linear_length': int(lengths[~circular].sum()),
+             # average depth of a base, and average length of a contig when
+             # each contig counts as often as it is covered
+             'mean_depth': depth_bases / total if total else 0.0,
+             'depth_weighted_length': depth_bases / depth_sum if depth_sum else 0.0}
+    if genome_size:
+        stats['ng50'], stats['lg50'] = nx(sorted_lengths, cumulative, genome_size * 0.5)
+    return stats
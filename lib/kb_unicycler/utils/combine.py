@@ -0,0 +1,160 @@
+import gzip
+import os
+import queue
+import threading
+import zlib
+
+# read/write chunk size for decompression and buffered copies
+BUFFER_SIZE = 16 << 20
+# decompressed chunks allowed to queue up between reader and writer
+QUEUE_DEPTH = 4
+# gzip level for plain inputs in compressed mode; fast, since the output
+# is scratch that only lives for one job
+COMPRESS_LEVEL = 1
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+def _copy_plain(src_path, out_fd):
+    """
+    _copy_plain: append a plain file to out_fd, in the kernel where possible
+    """
+    with open(src_path, 'rb') as src:
+        in_fd = src.fileno()
+        remaining = os.fstat(in_fd).st_size
+        copy = getattr(os, 'copy_file_range', None)
+        try:
+            while remaining > 0:
+                count = min(remaining, 1 << 30)
+                if copy is not None:
+                    n = copy(in_fd, out_fd, count)
+                else:
+                    n = os.sendfile(out_fd, in_fd, None, count)
+                if n == 0:
+                    break
+                remaining -= n
+        except OSError:
+            # e.g. different filesystems or no kernel support; the file
+            # positions have advanced past whatever was already copied
+            pass
+        while True:
+            data = src.read(BUFFER_SIZE)
+            if not data:
+                break
+            _write_all(out_fd, data)
+
+
+def _copy_gzip(src_path, out_fd):
+    """
+    _copy_gzip: append a gzipped file to out_fd, decompressing in a worker
+    thread so inflate and write overlap
+    """
+    chunks = queue.Queue(maxsize=QUEUE_DEPTH)
+    stop = threading.Event()
+
+    def read_chunks():
+        try:
+            with gzip.open(src_path, 'rb') as src:
+                while not stop.is_set():
+                    data = src.read(BUFFER_SIZE)
+                    if not data:
+                        break
+                    chunks.put(data)
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+
+    reader = threading.Thread(target=read_chunks, daemon=True)
+    reader.start()
+    try:
+        while True:
+            data = chunks.get()
+            if data is None:
+                break
+            if isinstance(data, Exception):
+                raise data
+            _write_all(out_fd, data)
+    finally:
+        stop.set()
+        # unblock the reader if it is waiting on a full queue
+        while reader.is_alive():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                reader.join(0.1)
+
+
+def _compress_plain(src_path, out_fd, level=COMPRESS_LEVEL):
+    """
+    _compress_plain: append a plain file to out_fd as one gzip member
+    """
+    # wbits 16 + 15: write a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(src_path, 'rb') as src:
+        while True:
+            data = src.read(BUFFER_SIZE)
+            if not data:
+                break
+            _write_all(out_fd, compressor.compress(data))
+    _write_all(out_fd, compressor.flush())
+
+
+class Combiner(object):
+    """
+    Appends plain and gzipped files to one new output file, one input at a
+    time, so callers can add files as they become available.
+
+    By default the output is plain.  With compress=True the output is gzip:
+    gzipped inputs are copied member by member without inflating them (a
+    multi-member gzip file reads back as the concatenation), and plain
+    inputs are compressed once at a fast level.
+    """
+
+    def __init__(self, out_path, compress=False):
+        self.out_path = out_path
+        self.compress = compress
+        # not O_APPEND: copy_file_range and sendfile refuse append-mode targets
+        self.out = open(out_path, 'wb', buffering=0)
+
+    def append(self, path, remove=True):
+        out_fd = self.out.fileno()
+        if path.endswith('.gz'):
+            if self.compress:
+                _copy_plain(path, out_fd)
+            else:
+                _copy_gzip(path, out_fd)
+        elif self.compress:
+            _compress_plain(path, out_fd)
+        else:
+            _copy_plain(path, out_fd)
+        if remove:
+            os.remove(path)
+
+    def size(self):
+        return os.fstat(self.out.fileno()).st_size
+
+    def close(self):
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def combine_files(paths, out_path, remove=True, compress=False):
+    """
+    combine_files: concatenate plain and gzipped files into one new file
+    (see Combiner), optionally removing the inputs as they are consumed.
+    Returns the number of bytes written.
+    """
+    with Combiner(out_path, compress) as combiner:
+        for path in paths:
+            combiner.append(path, remove)
+        return combiner.size()
@@ -0,0 +1,62 @@
+import gzip
+import threading
+from collections import deque
+
+# lines of the log kept in memory, for the report's log tab
+CONSOLE_LINES = 10000
+
+
+def is_noise(line):
+    """
+    is_noise: terminal control output and progress counters that aren't
+    worth keeping in a log
+    """
+    return line.startswith('tput') or line.lstrip().startswith('0 / ')
+
+
+class ConsoleLog(object):
+    """
+    Log sink used in place of the console list.  Every line is written to a
+    gzipped file as it arrives, and only the last max_lines lines are kept
+    in memory; iterating gives those lines.  Progress and tput noise is
+    dropped on the way in.  Safe to append to from several threads.
+    """
+
+    def __init__(self, path, max_lines=CONSOLE_LINES):
+        self.path = path
+        self.lines = deque(maxlen=max_lines)
+        # lines logged, after filtering, including those no longer in memory
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wt')
+
+    def append(self, line):
+        if is_noise(line):
+            return
+        with self._lock:
+            self.lines.append(line)
+            self.count += 1
+            if self._file is not None:
+                self._file.write(line + '\n')
+
+    def dropped(self):
+        """
+        dropped: number of lines logged that are only in the file
+        """
+        return self.count - len(self.lines)
+
+    def close(self):
+        """
+        close: finish the log file; later lines are only kept in memory
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.lines))
+
+    def __len__(self):
+        return len(self.lines)
@@ -0,0 +1,205 @@
+import fnmatch
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# read chunk size while compressing and copying members
+BUFFER_SIZE = 16 << 20
+# same default level as zipfile
+COMPRESS_LEVEL = 6
+# members that are already compressed, and gain nothing from deflate
+STORED_EXTENSIONS = ('.gz', '.bgz', '.bz2', '.xz', '.zip', '.bam', '.png', '.jpg', '.jpeg',
+                     '.gif', '.pdf')
+
+_DEFLATED = 8
+_STORED = 0
+_UTF8_NAMES = 0x800
+# sizes, offsets and counts from these up go in zip64 records, with the
+# classic fields set to the marker values (same limits as zipfile)
+_ZIP64_LIMIT = (1 << 31) - 1
+_ZIP64_COUNT_LIMIT = (1 << 16) - 1
+_ZIP64_MARKER = 0xFFFFFFFF
+_ZIP64_COUNT_MARKER = 0xFFFF
+_ZIP64_VERSION = 45
+_DEFAULT_VERSION = 20
+# 'made by' unix, so the file modes in the external attributes are used
+_MADE_BY_UNIX = 3 << 8
+
+
+def select_members(folder_path, include=None, exclude=()):
+    """
+    select_members: the files under folder_path to package, as a list of
+    (path, path relative to folder_path).  include and exclude are lists
+    of glob patterns matched against the relative path; a file is kept if
+    it matches some include pattern (or include is None) and no exclude
+    pattern.
+    """
+    members = []
+    for root, folders, files in os.walk(folder_path):
+        folders.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            relative = os.path.relpath(path, folder_path)
+            if include is not None and not any(fnmatch.fnmatch(relative, pattern)
+                                               for pattern in include):
+                continue
+            if any(fnmatch.fnmatch(relative, pattern) for pattern in exclude):
+                continue
+            members.append((path, relative))
+    return members
+
+
+def _dos_date_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class _Member(object):
+    def __init__(self, path, arcname):
+        self.path = path
+        self.arcname = arcname
+        st = os.stat(path)
+        self.mode = st.st_mode
+        self.dos_time, self.dos_date = _dos_date_time(st.st_mtime)
+        self.method = _STORED if path.lower().endswith(STORED_EXTENSIONS) else _DEFLATED
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        # where the data to copy into the archive is
+        self.data_path = path
+        self.offset = 0
+
+
+def _prepare(member, tmp_dir, level):
+    """
+    _prepare: checksum a member, and deflate it to a temporary file unless it
+    is stored as is
+    """
+    crc = 0
+    size = 0
+    with open(member.path, 'rb') as src:
+        if member.method == _STORED:
+            while True:
+                data = src.read(BUFFER_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+            member.compressed_size = size
+        else:
+            # raw deflate stream, as zip members have no zlib header
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            fd, member.data_path = tempfile.mkstemp(dir=tmp_dir)
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    data = src.read(BUFFER_SIZE)
+                    if not data:
+                        break
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    out.write(compressor.compress(data))
+                out.write(compressor.flush())
+                member.compressed_size = out.tell()
+    member.crc = crc
+    member.size = size
+    return member
+
+
+def _zip64_extra(values):
+    return struct.pack('<HH' + 'Q' * len(values), 1, 8 * len(values), *values)
+
+
+def _write_member(out, member):
+    member.offset = out.tell()
+    name = member.arcname.encode('utf-8')
+    zip64 = member.size >= _ZIP64_LIMIT or member.compressed_size >= _ZIP64_LIMIT
+    extra = _zip64_extra([member.size, member.compressed_size]) if zip64 else b''
+    out.write(struct.pack('<IHHHHHIIIHH', 0x04034b50,
+                          _ZIP64_VERSION if zip64 else _DEFAULT_VERSION, _UTF8_NAMES,
+                          member.method, member.dos_time, member.dos_date, member.crc,
+                          _ZIP64_MARKER if zip64 else member.compressed_size,
+                          _ZIP64_MARKER if zip64 else member.size,
+                          len(name), len(extra)))
+    out.write(name)
+    out.write(extra)
+    with open(member.data_path, 'rb') as data:
+        shutil.copyfileobj(data, out, BUFFER_SIZE)
+    if member.data_path != member.path:
+        os.remove(member.data_path)
+
+
+def _write_central_directory(out, members):
+    start = out.tell()
+    for member in members:
+        name = member.arcname.encode('utf-8')
+        zip64_values = []
+        size = member.size
+        compressed_size = member.compressed_size
+        offset = member.offset
+        if size >= _ZIP64_LIMIT:
+            zip64_values.append(size)
+            size = _ZIP64_MARKER
+        if compressed_size >= _ZIP64_LIMIT:
+            zip64_values.append(compressed_size)
+            compressed_size = _ZIP64_MARKER
+        if offset >= _ZIP64_LIMIT:
+            zip64_values.append(offset)
+            offset = _ZIP64_MARKER
+        extra = _zip64_extra(zip64_values) if zip64_values else b''
+        version = _ZIP64_VERSION if zip64_values else _DEFAULT_VERSION
+        out.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, _MADE_BY_UNIX | version,
+                              version, _UTF8_NAMES, member.method, member.dos_time,
+                              member.dos_date, member.crc, compressed_size, size, len(name),
+                              len(extra), 0, 0, 0, (member.mode & 0xFFFF) << 16, offset))
+        out.write(name)
+        out.write(extra)
+    end = out.tell()
+    count = len(members)
+    size = end - start
+    if count >= _ZIP64_COUNT_LIMIT or size >= _ZIP64_LIMIT or start >= _ZIP64_LIMIT:
+        out.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, _MADE_BY_UNIX | _ZIP64_VERSION,
+                              _ZIP64_VERSION, 0, 0, count, count, size, start))
+        out.write(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+        count = min(count, _ZIP64_COUNT_MARKER)
+        size = min(size, _ZIP64_MARKER)
+        start = _ZIP64_MARKER
+    out.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, size, start, 0))
+
+
+def write_zip(members, output_path, workers=4, level=COMPRESS_LEVEL):
+    """
+    write_zip: write a zip archive of members, a list of (path, name in the
+    archive).  Members are deflated on a pool of workers, each into its own
+    temporary file next to the archive, and copied into the archive in
+    order as they finish, so at most a few members are held on disk and
+    none in memory.  Already-compressed members are stored as is.
+    Returns the number of members written.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    written = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool, open(output_path, 'wb') as out:
+            pending = deque()
+            next_member = 0
+            while next_member < len(members) or pending:
+                # keep the pool busy while the oldest member is written
+                while next_member < len(members) and len(pending) < 2 * workers:
+                    path, arcname = members[next_member]
+                    pending.append(pool.submit(_prepare, _Member(path, arcname), tmp_dir,
+                                               level))
+                    next_member += 1
+                member = pending.popleft().result()
+                _write_member(out, member)
+                written.append(member)
+            _write_central_directory(out, written)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return len(written)
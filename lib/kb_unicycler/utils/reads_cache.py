@@ -0,0 +1,112 @@
+import fcntl
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+from kb_unicycler.utils.combine import Combiner
+
+
+class ReadsCache(object):
+    """
+    On-disk cache of downloaded reads files, shared between jobs on a node.
+
+    Entries are keyed by the versioned workspace reference (UPA) of the
+    reads library, which never changes once saved, so entries never need
+    to be invalidated.  Files are stored gzip-compressed.  When the cache
+    grows past max_bytes the least recently used entries are evicted.
+
+    A lock file serializes changes to the cache: readers take a shared
+    lock while they link or copy files out, and writers take an exclusive
+    lock to add an entry and evict old ones.
+    """
+
+    LOCK_FILE = '.lock'
+    TMP_PREFIX = '.tmp_'
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @contextmanager
+    def _lock(self, mode):
+        with open(os.path.join(self.cache_dir, self.LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _entry_dir(self, upa):
+        parts = upa.split('/')
+        if len(parts) != 3 or not all(p.isdigit() for p in parts):
+            raise ValueError('Reads cache key must be a versioned reference, not ' + upa)
+        return os.path.join(self.cache_dir, '_'.join(parts))
+
+    def get(self, upa, dest_dir):
+        """
+        get: link or copy the cached files for upa into dest_dir.  Returns a
+        dict of file key ('fwd', 'rev') to path, or None on a cache miss.
+        """
+        entry_dir = self._entry_dir(upa)
+        with self._lock(fcntl.LOCK_SH):
+            if not os.path.isdir(entry_dir):
+                return None
+            files = dict()
+            for name in sorted(os.listdir(entry_dir)):
+                key = name.split('.')[0]
+                dest = os.path.join(dest_dir, 'cached_' + str(uuid.uuid4()) + '_' + name)
+                try:
+                    os.link(os.path.join(entry_dir, name), dest)
+                except OSError:
+                    # different filesystem
+                    shutil.copyfile(os.path.join(entry_dir, name), dest)
+                files[key] = dest
+            # mark as recently used
+            os.utime(entry_dir)
+        return files
+
+    def put(self, upa, files):
+        """
+        put: add the reads files for upa (a dict of file key to path) to the
+        cache, compressing them if needed; the originals are left in place.
+        """
+        entry_dir = self._entry_dir(upa)
+        if os.path.isdir(entry_dir):
+            return
+        tmp_dir = os.path.join(self.cache_dir, self.TMP_PREFIX + str(uuid.uuid4()))
+        os.makedirs(tmp_dir)
+        try:
+            for key, path in files.items():
+                with Combiner(os.path.join(tmp_dir, key + '.fastq.gz'), compress=True) as cached:
+                    cached.append(path, remove=False)
+            with self._lock(fcntl.LOCK_EX):
+                if os.path.isdir(entry_dir):
+                    # another job got there first
+                    return
+                os.rename(tmp_dir, entry_dir)
+                self._evict(keep=entry_dir)
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _evict(self, keep):
+        # called with the exclusive lock held
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
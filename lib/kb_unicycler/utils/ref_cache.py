@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+# responses kept in memory
+DEFAULT_MAX_ENTRIES = 4096
+
+_VERSIONED_REF = re.compile(r'^\d+/\d+/\d+$')
+
+
+def is_versioned_ref(ref):
+    """
+    is_versioned_ref: true for a wsid/objid/ver reference, which always
+    names the same, unchangeable object
+    """
+    return isinstance(ref, str) and _VERSIONED_REF.match(ref) is not None
+
+
+def token_namespace(token):
+    """
+    token_namespace: cache namespace for a token, so a response fetched
+    with one user's permissions is never handed to another user
+    """
+    if not token:
+        return 'anonymous'
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:32]
+
+
+class RefCache(object):
+    """
+    Cache of workspace responses for versioned references, which never
+    change.  Entries are keyed by (namespace, kind of response, ref).  The
+    last max_entries are kept in memory; with a cache_dir they are also
+    written there as json, so they survive between jobs on the same node.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        namespace, kind, ref = key
+        return os.path.join(self.cache_dir, namespace, kind, ref.replace('/', '_') + '.json')
+
+    def _remember(self, key, value):
+        # called with the lock held
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, namespace, kind, ref):
+        key = (namespace, kind, ref)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        value = None
+        if self.cache_dir:
+            try:
+                with open(self._path(key)) as f:
+                    value = json.load(f)
+            except (IOError, OSError, ValueError):
+                value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(key, value)
+        return value
+
+    def put(self, namespace, kind, ref, value):
+        key = (namespace, kind, ref)
+        with self._lock:
+            self._remember(key, value)
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        tmp_path = path + '.tmp_' + str(uuid.uuid4())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+            # atomic, so other jobs never see part of an entry
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            # the disk tier is only an optimization
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class _CachedClient(object):
+    # passes every method the cache doesn't handle through to the client
+
+    def __init__(self, client, cache, token):
+        self._client = client
+        self._cache = cache
+        self._namespace = token_namespace(token)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _cached_objects(self, kind, objects, fetch):
+        """
+        _cached_objects: one result per object spec; specs that are just a
+        versioned ref are looked up in the cache, and the rest are fetched
+        in one call of fetch(list of specs) -> list of results.  Results that
+        are None (errors) aren't cached.
+        """
+        results = [None] * len(objects)
+        misses = []
+        for i, spec in enumerate(objects):
+            ref = spec.get('ref') if list(spec) == ['ref'] else None
+            if is_versioned_ref(ref):
+                results[i] = self._cache.get(self._namespace, kind, ref)
+            if results[i] is None:
+                misses.append(i)
+        if len(misses) > 0:
+            fetched = fetch([objects[i] for i in misses])
+            for i, value in zip(misses, fetched):
+                results[i] = value
+                ref = objects[i].get('ref') if list(objects[i]) == ['ref'] else None
+                if value is not None and is_versioned_ref(ref):
+                    self._cache.put(self._namespace, kind, ref, value)
+        return results
+
+
+class CachedWorkspace(_CachedClient):
+    """
+    Workspace client whose get_object_info3 and get_objects2 answer from a
+    RefCache for objects given as versioned refs
+    """
+
+    def get_object_info3(self, params, context=None):
+        if set(params) - {'objects', 'includeMetadata', 'ignoreErrors'}:
+            return self._client.get_object_info3(params, context)
+        kind = 'object_info_meta' if params.get('includeMetadata') else 'object_info'
+
+        def fetch(objects):
+            ret = self._client.get_object_info3(dict(params, objects=objects), context)
+            return [None if info is None else {'info': info, 'path': path}
+                    for info, path in zip(ret['infos'], ret['paths'])]
+
+        results = self._cached_objects(kind, params['objects'], fetch)
+        return {'infos': [None if r is None else r['info'] for r in results],
+                'paths': [None if r is None else r['path'] for r in results]}
+
+    def get_objects2(self, params, context=None):
+        if set(params) - {'objects', 'no_data', 'ignoreErrors'}:
+            return self._client.get_objects2(params, context)
+        kind = 'object_no_data' if params.get('no_data') else 'object'
+
+        def fetch(objects):
+            return self._client.get_objects2(dict(params, objects=objects), context)['data']
+
+        return {'data': self._cached_objects(kind, params['objects'], fetch)}
+
+
+class CachedSetAPI(_CachedClient):
+    """
+    SetAPI client whose get_reads_set_v1 answers from a RefCache for sets
+    given as versioned refs
+    """
+
+    def get_reads_set_v1(self, params, context=None):
+        ref = params.get('ref')
+        if set(params) - {'ref', 'include_item_info'} or not is_versioned_ref(ref):
+            return self._client.get_reads_set_v1(params, context)
+        kind = 'reads_set_v1_info' if params.get('include_item_info') else 'reads_set_v1'
+        ret = self._cache.get(self._namespace, kind, ref)
+        if ret is None:
+            ret = self._client.get_reads_set_v1(params, context)
+            self._cache.put(self._namespace, kind, ref, ret)
+        return ret
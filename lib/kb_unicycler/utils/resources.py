@@ -0,0 +1,313 @@
+import os
+import threading
+import time
+
+import numpy as np
+import psutil
+
+# cgroup v2 exposes everything under one unified hierarchy; v1 splits it
+# per controller
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def _read_first_line(path):
+    try:
+        with open(path, 'r') as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def parse_cpu_list(cpu_list):
+    """
+    parse_cpu_list: count the CPUs in a cpuset list such as '0-3,8,10-11'
+    """
+    count = 0
+    for part in cpu_list.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-', 1)
+            count += int(hi) - int(lo) + 1
+        else:
+            count += 1
+    return count
+
+
+def cgroup_cpu_quota(root=CGROUP_ROOT):
+    """
+    cgroup_cpu_quota: number of CPUs allowed by the CFS quota, as a float,
+    or None if there is no quota
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    line = _read_first_line(os.path.join(root, 'cpu.max'))
+    if line:
+        fields = line.split()
+        if len(fields) == 2 and fields[0] != 'max':
+            quota, period = int(fields[0]), int(fields[1])
+            if quota > 0 and period > 0:
+                return quota / float(period)
+        return None
+
+    # cgroup v1: quota is -1 when unlimited
+    for controller in ('cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+        quota = _read_first_line(os.path.join(root, controller, 'cpu.cfs_quota_us'))
+        period = _read_first_line(os.path.join(root, controller, 'cpu.cfs_period_us'))
+        if quota is None or period is None:
+            continue
+        quota, period = int(quota), int(period)
+        if quota > 0 and period > 0:
+            return quota / float(period)
+        return None
+    return None
+
+
+def cpuset_cpu_count(root=CGROUP_ROOT):
+    """
+    cpuset_cpu_count: number of CPUs this process may be scheduled on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        try:
+            return len(os.sched_getaffinity(0))
+        except OSError:
+            pass
+    for path in (os.path.join(root, 'cpuset.cpus.effective'),
+                 os.path.join(root, 'cpuset', 'cpuset.effective_cpus'),
+                 os.path.join(root, 'cpuset', 'cpuset.cpus')):
+        line = _read_first_line(path)
+        if line:
+            return parse_cpu_list(line)
+    return None
+
+
+def effective_cpu_count(root=CGROUP_ROOT):
+    """
+    effective_cpu_count: the number of threads we can actually keep busy,
+    i.e. the smallest of the host CPU count, the cpuset and the cgroup quota.
+    Returns a dict with the individual values and the chosen 'threads'.
+    """
+    host = psutil.cpu_count(logical=True) or 1
+    cpuset = cpuset_cpu_count(root)
+    quota = cgroup_cpu_quota(root)
+
+    threads = host
+    if cpuset:
+        threads = min(threads, cpuset)
+    if quota:
+        # a fractional quota still gets at least one thread
+        threads = min(threads, max(1, int(quota)))
+    return {'host_cpus': host,
+            'cpuset_cpus': cpuset,
+            'cpu_quota': quota,
+            'threads': max(1, threads)}
+
+
+# cgroup v1 reports "no limit" as a huge page-rounded number
+_CGROUP_V1_UNLIMITED = 1 << 60
+
+
+def cgroup_memory_limit(root=CGROUP_ROOT):
+    """
+    cgroup_memory_limit: memory limit of the container in bytes, or None
+    if there is no limit
+    """
+    line = _read_first_line(os.path.join(root, 'memory.max'))
+    if line:
+        if line == 'max':
+            return None
+        return int(line)
+
+    line = _read_first_line(os.path.join(root, 'memory', 'memory.limit_in_bytes'))
+    if line:
+        limit = int(line)
+        if limit <= 0 or limit >= _CGROUP_V1_UNLIMITED:
+            return None
+        return limit
+    return None
+
+
+def effective_memory(root=CGROUP_ROOT):
+    """
+    effective_memory: the memory we can actually use, i.e. the smaller of
+    physical memory and the cgroup limit.  Returns a dict with the
+    individual values and the chosen 'memory' in bytes.
+    """
+    host = psutil.virtual_memory().total
+    limit = cgroup_memory_limit(root)
+    memory = host
+    if limit:
+        memory = min(memory, limit)
+    return {'host_memory': host,
+            'cgroup_memory': limit,
+            'memory': memory}
+
+
+def memory_caps_gb(memory, spades_fraction=0.85, pilon_fraction=0.75):
+    """
+    memory_caps_gb: split a memory budget (bytes) into the SPAdes -m limit
+    and the Pilon java heap, both in whole GB.  Unicycler runs SPAdes and
+    Pilon one after the other, so each may take most of the budget; the
+    remainder covers unicycler itself and the JVM's off-heap overhead.
+    """
+    gb = memory / float(1 << 30)
+    return {'spades_memory_gb': max(1, int(gb * spades_fraction)),
+            'pilon_heap_gb': max(1, int(gb * pilon_fraction))}
+
+
+def directory_size(path):
+    """
+    directory_size: bytes allocated on disk under path
+    """
+    total = 0
+    for root, folders, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_blocks * 512
+            except OSError:
+                # removed while we were walking
+                pass
+    return total
+
+
+class ScratchUsage(object):
+    """
+    Tracks scratch disk usage at the stage boundaries of a job, and the
+    peak seen so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.samples = []
+        self.peak = 0
+        self.peak_stage = None
+
+    def sample(self, stage):
+        size = directory_size(self.path)
+        self.samples.append((stage, size))
+        if size > self.peak:
+            self.peak = size
+            self.peak_stage = stage
+        return size
+
+
+# one row per sample of a process tree
+PROCESS_SAMPLE_DTYPE = [('seconds', np.float64), ('processes', np.int32),
+                        ('cpu_percent', np.float64), ('rss', np.int64), ('open_files', np.int32),
+                        ('read_bytes', np.int64), ('write_bytes', np.int64),
+                        ('scratch_bytes', np.int64)]
+
+
+class ProcessSampler(object):
+    """
+    Samples the resource use of a process and all its descendants on a
+    background thread every interval seconds, until stopped: CPU% (100 per
+    busy core), resident memory, open files, bytes read and written, and
+    scratch disk usage if a ScratchUsage is given (which then also sees the
+    peak during the run).  Read and written bytes are running totals that
+    include processes that have already exited.
+    """
+
+    def __init__(self, pid, interval=10, scratch_usage=None, stage='running'):
+        self.pid = pid
+        self.interval = interval
+        self.scratch_usage = scratch_usage
+        self.stage = stage
+        self.rows = []
+        self._procs = dict()
+        self._io = dict()
+        self._start = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._start = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        self.sample()
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """
+        stop: stop sampling, and return the samples (see samples())
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples()
+
+    def _tree(self):
+        try:
+            root = psutil.Process(self.pid)
+            procs = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return []
+        tree = []
+        for proc in procs:
+            # keep the same Process objects, which remember the CPU times
+            # of the last sample
+            known = self._procs.get(proc.pid)
+            if known is None:
+                self._procs[proc.pid] = proc
+                known = proc
+            tree.append(known)
+        return tree
+
+    def sample(self):
+        processes = 0
+        cpu = 0.0
+        rss = 0
+        open_files = 0
+        for proc in self._tree():
+            try:
+                with proc.oneshot():
+                    cpu += proc.cpu_percent(interval=None)
+                    rss += proc.memory_info().rss
+                    open_files += len(proc.open_files())
+                    io = proc.io_counters()
+                    self._io[proc.pid] = (io.read_bytes, io.write_bytes)
+                processes += 1
+            except (psutil.Error, AttributeError):
+                # gone already, or no io counters on this platform
+                pass
+        scratch = 0
+        if self.scratch_usage is not None:
+            scratch = self.scratch_usage.sample(self.stage)
+        self.rows.append((time.time() - self._start, processes, cpu, rss, open_files,
+                          sum(r for r, w in self._io.values()),
+                          sum(w for r, w in self._io.values()), scratch))
+
+    def samples(self):
+        """
+        samples: the samples so far, as a numpy structured array
+        (PROCESS_SAMPLE_DTYPE)
+        """
+        return np.array(self.rows, dtype=PROCESS_SAMPLE_DTYPE)
+
+    def summary(self):
+        """
+        summary: peaks and totals over the samples, as a dict
+        """
+        samples = self.samples()
+        if len(samples) == 0:
+            return {'samples': 0}
+        return {'samples': len(samples),
+                'seconds': float(samples['seconds'][-1]),
+                'peak_cpu_percent': float(samples['cpu_percent'].max()),
+                'mean_cpu_percent': float(samples['cpu_percent'].mean()),
+                'peak_rss': int(samples['rss'].max()),
+                'peak_open_files': int(samples['open_files'].max()),
+                'peak_processes': int(samples['processes'].max()),
+                'read_bytes': int(samples['read_bytes'][-1]),
+                'write_bytes': int(samples['write_bytes'][-1]),
+                'peak_scratch_bytes': int(samples['scratch_bytes'].max())}
+
+    def write_csv(self, path):
+        samples = self.samples()
+        with open(path, 'w') as f:
+            f.write(','.join(samples.dtype.names) + '\n')
+            for row in samples:
+                f.write(','.join(str(value) for value in row.tolist()) + '\n')
@@ -0,0 +1,423 @@
+import gzip
+import mmap
+import sys
+import time
+
+import numpy as np
+
+# bytes scanned per step; chunks are cut at line boundaries
+CHUNK_SIZE = 64 << 20
+
+_NL = ord('\n')
+_CR = ord('\r')
+_AT = ord('@')
+_PLUS = ord('+')
+_GT = ord('>')
+
+
+def _mmap_chunks(path, chunk_size):
+    """
+    _mmap_chunks: yield views of a memory-mapped plain file, each ending
+    just after a newline (except possibly the last)
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        if f.tell() == 0:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data = np.frombuffer(mm, dtype=np.uint8)
+    pos = 0
+    while pos < len(data):
+        end = min(pos + chunk_size, len(data))
+        if end < len(data):
+            last_nl = mm.rfind(b'\n', pos, end)
+            if last_nl >= 0:
+                end = last_nl + 1
+            else:
+                # a single line longer than the chunk: take all of it
+                next_nl = mm.find(b'\n', end)
+                end = next_nl + 1 if next_nl >= 0 else len(data)
+        yield data[pos:end]
+        pos = end
+    # the map is unmapped once the last view of it is gone
+
+
+def _gzip_chunks(path, chunk_size):
+    """
+    _gzip_chunks: yield decompressed chunks of a gzipped file, each ending
+    just after a newline (except possibly the last)
+    """
+    remainder = b''
+    with gzip.open(path, 'rb') as f:
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            block = remainder + block
+            last_nl = block.rfind(b'\n')
+            if last_nl < 0:
+                remainder = block
+                continue
+            remainder = block[last_nl + 1:]
+            yield np.frombuffer(block, dtype=np.uint8, count=last_nl + 1)
+    if remainder:
+        yield np.frombuffer(remainder, dtype=np.uint8)
+
+
+def line_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+    line_chunks: yield uint8 arrays covering a plain or gzipped file, each
+    made up of whole lines
+    """
+    if path.endswith('.gz'):
+        return _gzip_chunks(path, chunk_size)
+    return _mmap_chunks(path, chunk_size)
+
+
+def _line_bounds(buf):
+    # start and (exclusive) end of every line in buf, not counting the
+    # newline; a final line without a newline still counts
+    ends = np.flatnonzero(buf == _NL)
+    if len(buf) > 0 and buf[-1] != _NL:
+        ends = np.append(ends, len(buf))
+    starts = np.empty_like(ends)
+    if len(ends) > 0:
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+    return starts, ends
+
+
+def _strip_cr(buf, starts, ends):
+    # line lengths, without a trailing carriage return
+    lengths = ends - starts
+    nonempty = lengths > 0
+    cr = np.zeros(len(lengths), dtype=bool)
+    cr[nonempty] = buf[ends[nonempty] - 1] == _CR
+    return lengths - cr
+
+
+def _fastq_lines(path, chunk_size):
+    """
+    _fastq_lines: yield (buf, line starts, line ends, line kinds, index of
+    the first line) for each chunk of a 4-line FASTQ file, where the kind
+    is the line's position in its record (0 header, 1 sequence, 2 '+',
+    3 quality).  Records are found by line position rather than by looking
+    for '@', which can also start a quality line.  Empty lines at the end
+    of the file are ignored.
+    """
+    line_no = 0
+    # past the last record, where only empty lines may follow
+    at_end = False
+    for buf in line_chunks(path, chunk_size):
+        starts, ends = _line_bounds(buf)
+        empty = _strip_cr(buf, starts, ends) == 0
+        if at_end:
+            if not np.all(empty):
+                raise ValueError('File ' + path + ' is not a 4-line FASTQ file')
+            continue
+        kind = (line_no + np.arange(len(ends))) % 4
+        # an empty line where a header should be ends the file; empty
+        # sequence and quality lines are a zero-length read
+        blank_headers = np.flatnonzero(empty & (kind == 0))
+        if len(blank_headers) > 0:
+            at_end = True
+            last = blank_headers[0]
+            if not np.all(empty[last:]):
+                raise ValueError('File ' + path + ' is not a 4-line FASTQ file')
+            starts, ends, kind = starts[:last], ends[:last], kind[:last]
+        if np.any(buf[starts[kind == 0]] != _AT) or \
+                np.any(buf[starts[kind == 2]] != _PLUS):
+            raise ValueError('File ' + path + ' is not a 4-line FASTQ file')
+        if len(ends) > 0:
+            yield buf, starts, ends, kind, line_no
+        line_no += len(ends)
+    if line_no % 4 != 0:
+        raise ValueError('File ' + path + ' has a truncated last FASTQ record')
+
+
+def fastq_read_lengths(path, chunk_size=CHUNK_SIZE):
+    """
+    fastq_read_lengths: exact length of every read in a plain or gzipped
+    4-line FASTQ file, as a numpy int64 array
+    """
+    lengths = [np.zeros(0, dtype=np.int64)]
+    for buf, starts, ends, kind, first_line in _fastq_lines(path, chunk_size):
+        seq = kind == 1
+        lengths.append(_strip_cr(buf, starts[seq], ends[seq]).astype(np.int64))
+    return np.concatenate(lengths)
+
+
+# probability that a base is correct, by quality character (phred+33)
+_ACCURACY = (1.0 - 10.0 ** (-np.maximum(np.arange(256) - 33, 0) / 10.0)).astype(np.float32)
+# smaller chunks for the quality pass, which expands each byte to a float
+QUALITY_CHUNK_SIZE = 16 << 20
+
+
+def fastq_read_stats(path, chunk_size=QUALITY_CHUNK_SIZE):
+    """
+    fastq_read_stats: length and mean base accuracy (from the phred+33
+    quality line) of every read in a plain or gzipped 4-line FASTQ file,
+    as numpy int64 and float64 arrays
+    """
+    lengths = [np.zeros(0, dtype=np.int64)]
+    accuracies = [np.zeros(0, dtype=np.float64)]
+    for buf, starts, ends, kind, first_line in _fastq_lines(path, chunk_size):
+        seq = kind == 1
+        lengths.append(_strip_cr(buf, starts[seq], ends[seq]).astype(np.int64))
+        qual = kind == 3
+        q_starts = starts[qual]
+        q_lengths = _strip_cr(buf, q_starts, ends[qual])
+        # sum accuracy over each quality line with one reduceat over
+        # alternating (line start, line end) boundaries
+        accuracy = _ACCURACY[buf]
+        bounds = np.empty(2 * len(q_starts), dtype=np.int64)
+        bounds[0::2] = q_starts
+        bounds[1::2] = np.minimum(q_starts + q_lengths, len(buf) - 1)
+        sums = np.add.reduceat(accuracy, bounds, dtype=np.float64)[0::2] \
+            if len(bounds) > 0 else np.zeros(0)
+        # reduceat gives the single element at an empty segment
+        sums[q_lengths == 0] = 0.0
+        # a quality line running to the very end of the buffer was cut
+        # short by the clamp above
+        at_end = np.flatnonzero((q_starts + q_lengths == len(buf)) & (q_lengths > 0))
+        for i in at_end:
+            sums[i] = accuracy[q_starts[i]:].sum(dtype=np.float64)
+        accuracies.append(sums / np.maximum(q_lengths, 1))
+    return np.concatenate(lengths), np.concatenate(accuracies)
+
+
+def select_reads(lengths, accuracies, max_bases):
+    """
+    select_reads: pick the reads to keep so that their total length fits in
+    max_bases, preferring reads with the most expected correct bases
+    (length times mean accuracy), i.e. long, high quality reads.  Returns a
+    boolean mask over the reads.
+    """
+    score = lengths * accuracies
+    order = np.argsort(-score, kind='stable')
+    n_keep = np.searchsorted(np.cumsum(lengths[order]), max_bases, side='right')
+    keep = np.zeros(len(lengths), dtype=bool)
+    keep[order[:n_keep]] = True
+    return keep
+
+
+def _write_kept_lines(out, buf, starts, ends, lines_kept):
+    # write each run of consecutive kept lines in one go
+    edges = np.flatnonzero(np.diff(np.concatenate(
+        ([False], lines_kept, [False])).astype(np.int8)))
+    for first, last in zip(edges[0::2], edges[1::2] - 1):
+        out.write(buf[starts[first]:min(ends[last] + 1, len(buf))].tobytes())
+        if ends[last] == len(buf):
+            # last line of the file had no newline
+            out.write(b'\n')
+
+
+def write_fastq_subset(path, keep, out_path, chunk_size=CHUNK_SIZE):
+    """
+    write_fastq_subset: copy the reads selected by the boolean mask keep
+    from a plain or gzipped 4-line FASTQ file to a new plain FASTQ file,
+    in their original order
+    """
+    with open(out_path, 'wb') as out:
+        for buf, starts, ends, kind, first_line in _fastq_lines(path, chunk_size):
+            lines_kept = keep[(first_line + np.arange(len(ends))) // 4]
+            if np.any(lines_kept):
+                _write_kept_lines(out, buf, starts, ends, lines_kept)
+
+
+def _fasta_lines(path, chunk_size):
+    """
+    _fasta_lines: yield (buf, line starts, line ends, header mask, record
+    index of each line, offset of buf in the file) for each chunk of a
+    plain or gzipped FASTA file; records may span any number of lines and
+    chunks
+    """
+    n_records = 0
+    offset = 0
+    for buf in line_chunks(path, chunk_size):
+        starts, ends = _line_bounds(buf)
+        header = buf[starts] == _GT
+        record = n_records + np.cumsum(header) - 1
+        if len(record) > 0 and record[0] < 0:
+            if np.any(ends[record < 0] > starts[record < 0]):
+                raise ValueError('File ' + path + ' is not a FASTA file')
+        n_records += int(np.count_nonzero(header))
+        yield buf, starts, ends, header, record, offset
+        offset += len(buf)
+
+
+def fasta_record_lengths(path, chunk_size=CHUNK_SIZE):
+    """
+    fasta_record_lengths: exact sequence length of every record in a plain
+    or gzipped FASTA file, as a numpy int64 array
+    """
+    n_records = 0
+    partial = []
+    for buf, starts, ends, header, record, offset in _fasta_lines(path, chunk_size):
+        if len(record) == 0:
+            continue
+        n_records = int(record[-1]) + 1
+        sequence = (record >= 0) & ~header
+        if not np.any(sequence):
+            continue
+        # per-record totals for this chunk, starting at its first record
+        first = int(record[sequence][0])
+        sums = np.bincount(record[sequence] - first,
+                           weights=_strip_cr(buf, starts[sequence], ends[sequence]))
+        partial.append((first, sums.astype(np.int64)))
+    lengths = np.zeros(n_records, dtype=np.int64)
+    for first, sums in partial:
+        lengths[first:first + len(sums)] += sums
+    return lengths
+
+
+def write_fasta_subset(path, keep, out_path, chunk_size=CHUNK_SIZE):
+    """
+    write_fasta_subset: copy the records selected by the boolean mask keep
+    from a plain or gzipped FASTA file to a new plain FASTA file, in their
+    original order
+    """
+    with open(out_path, 'wb') as out:
+        for buf, starts, ends, header, record, offset in _fasta_lines(path, chunk_size):
+            lines_kept = np.zeros(len(record), dtype=bool)
+            lines_kept[record >= 0] = keep[record[record >= 0]]
+            if np.any(lines_kept):
+                _write_kept_lines(out, buf, starts, ends, lines_kept)
+
+
+# G or C, either case
+_GC = np.zeros(256, dtype=np.uint8)
+_GC[[ord(c) for c in 'GCgc']] = 1
+
+
+def _parse_contig_header(header):
+    # unicycler headers look like '>1 length=5000 depth=1.00x circular=true'
+    fields = header.split()
+    contig_id = fields[0] if fields else ''
+    depth = 0.0
+    circular = False
+    for field in fields[1:]:
+        if field.startswith('depth='):
+            try:
+                depth = float(field[6:].rstrip('x'))
+            except ValueError:
+                pass
+        elif field == 'circular=true':
+            circular = True
+    return contig_id, depth, circular
+
+
+def index_fasta(path, chunk_size=CHUNK_SIZE):
+    """
+    index_fasta: read a FASTA file once (memory-mapped unless gzipped) and
+    return a numpy structured array with one row per record: id, offset
+    (of the first base), length, line_bases and line_width (as in a .fai
+    index), depth and circular (from unicycler's headers) and gc (fraction
+    of G and C bases)
+    """
+    ids = []
+    depths = []
+    circular = []
+    offsets = []
+    # (first record, per-record sums) for each chunk
+    length_parts = []
+    gc_parts = []
+    # (record, value) for the first sequence line of each record
+    first_lines = []
+    after_header = False
+    for buf, starts, ends, header, record, offset in _fasta_lines(path, chunk_size):
+        if len(record) == 0:
+            continue
+        for i in np.flatnonzero(header):
+            contig_id, depth, circ = _parse_contig_header(
+                buf[starts[i] + 1:ends[i]].tobytes().decode('utf-8', 'replace'))
+            ids.append(contig_id)
+            depths.append(depth)
+            circular.append(circ)
+            offsets.append(offset + min(ends[i] + 1, len(buf)))
+        sequence = (record >= 0) & ~header
+        if np.any(sequence):
+            line_lengths = _strip_cr(buf, starts, ends)
+            # lines are contiguous, so summing from each line start to the
+            # next covers each whole line (newlines aren't G or C)
+            line_gc = np.add.reduceat(_GC[buf], starts, dtype=np.int64)
+            first = int(record[sequence][0])
+            length_parts.append((first, np.bincount(record[sequence] - first,
+                                                    weights=line_lengths[sequence])))
+            gc_parts.append((first, np.bincount(record[sequence] - first,
+                                                weights=line_gc[sequence])))
+            follows_header = np.concatenate(([after_header], header[:-1]))
+            for i in np.flatnonzero(sequence & follows_header):
+                first_lines.append((record[i], line_lengths[i], ends[i] - starts[i] + 1))
+        after_header = bool(header[-1])
+
+    n = len(ids)
+    id_width = max([len(contig_id) for contig_id in ids] + [1])
+    table = np.zeros(n, dtype=[('id', 'U' + str(id_width)), ('offset', np.int64),
+                               ('length', np.int64), ('line_bases', np.int64),
+                               ('line_width', np.int64), ('depth', np.float64),
+                               ('circular', bool), ('gc', np.float64)])
+    table['id'] = ids
+    table['offset'] = offsets
+    table['depth'] = depths
+    table['circular'] = circular
+    gc = np.zeros(n, dtype=np.float64)
+    for first, sums in length_parts:
+        table['length'][first:first + len(sums)] += sums.astype(np.int64)
+    for first, sums in gc_parts:
+        gc[first:first + len(sums)] += sums
+    table['gc'] = gc / np.maximum(table['length'], 1)
+    for rec, bases, width in first_lines:
+        table['line_bases'][rec] = bases
+        table['line_width'][rec] = width
+    return table
+
+
+def write_fai(table, fai_path):
+    """
+    write_fai: write a samtools-compatible .fai index for a table from
+    index_fasta
+    """
+    with open(fai_path, 'w') as fai:
+        for row in table:
+            fai.write('{}\t{}\t{}\t{}\t{}\n'.format(
+                row['id'], row['length'], row['offset'], row['line_bases'], row['line_width']))
+
+
+def _python_read_lengths(path):
+    # line-by-line reference scan, for the benchmark
+    lengths = []
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for i, line in enumerate(f):
+            if i % 4 == 1:
+                lengths.append(len(line.rstrip(b'\r\n')))
+    return lengths
+
+
+def benchmark(path):
+    """
+    benchmark: compare the vectorized scan with a line-by-line scan of
+    the same file, and return both throughputs in MB/s
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        size = sum(len(block) for block in iter(lambda: f.read(CHUNK_SIZE), b''))
+    start = time.time()
+    lengths = fastq_read_lengths(path)
+    numpy_time = time.time() - start
+    start = time.time()
+    python_lengths = _python_read_lengths(path)
+    python_time = time.time() - start
+    if not np.array_equal(lengths, python_lengths):
+        raise ValueError('Scans of ' + path + ' disagree')
+    mb = size / float(1 << 20)
+    return {'reads': len(lengths),
+            'bases': int(lengths.sum()),
+            'numpy_mb_per_s': mb / max(numpy_time, 1e-9),
+            'python_mb_per_s': mb / max(python_time, 1e-9)}
+
+
+if __name__ == '__main__':
+    for fastq_path in sys.argv[1:]:
+        print(fastq_path, benchmark(fastq_path))
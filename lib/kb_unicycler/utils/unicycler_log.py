@@ -0,0 +1,70 @@
+import re
+import time
+
+# unicycler starts each phase with a header like
+# 'Bridging graph with long reads (2020-05-01 12:00:00)'
+SECTION_HEADER = re.compile(r'^([A-Z][^()]*?) \((\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\)$')
+ROTATION_SECTION = 'Rotating completed replicons'
+ROTATION_COLUMNS = ['segment', 'length', 'depth', 'starting_gene', 'position', 'strand',
+                    'identity', 'coverage']
+
+
+class UnicyclerLogParser(object):
+    """
+    Parses unicycler's stdout a line at a time, as it runs.  Records when
+    each phase (section header) started and how long it took, by our clock,
+    and the table of replicons rotated to a starting gene.
+
+    phases is a list of dicts with the 'phase' name, unicycler's 'timestamp'
+    for it and its 'seconds' (None until the next phase starts, or finish()
+    is called).  rotations maps segment (contig id) to a dict of the columns
+    of its row in the rotation table.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.rotations = dict()
+        self._phase_start = None
+        self._in_rotation_table = False
+
+    def _end_phase(self, now):
+        if self.phases and self.phases[-1]['seconds'] is None:
+            self.phases[-1]['seconds'] = now - self._phase_start
+
+    def feed(self, line, now=None):
+        if now is None:
+            now = time.time()
+        line = line.strip()
+        match = SECTION_HEADER.match(line)
+        if match:
+            self._end_phase(now)
+            self.phases.append({'phase': match.group(1),
+                                'timestamp': match.group(2),
+                                'seconds': None})
+            self._phase_start = now
+            self._in_rotation_table = False
+            return
+        if not self.phases or self.phases[-1]['phase'] != ROTATION_SECTION:
+            return
+        fields = line.split()
+        if fields[:1] == ['Segment']:
+            # the section explains itself before the table starts
+            self._in_rotation_table = True
+        elif self._in_rotation_table and len(fields) > 3:
+            row = dict(zip(ROTATION_COLUMNS, fields))
+            if row['starting_gene'] == 'none':
+                row['starting_gene'] = 'none found'
+            self.rotations[fields[0]] = row
+
+    def finish(self, now=None):
+        """
+        finish: close off the last phase once unicycler has exited
+        """
+        self._end_phase(time.time() if now is None else now)
+
+    def phase_seconds(self):
+        """
+        phase_seconds: list of (phase, seconds) for the finished phases
+        """
+        return [(phase['phase'], phase['seconds']) for phase in self.phases
+                if phase['seconds'] is not None]
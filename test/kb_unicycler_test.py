@@ -1,14 +1,18 @@
 from __future__ import print_function
 import unittest
+from unittest import mock
 import os
+import gzip
 import time
 import json
+import zipfile
 
 from os import environ
 from configparser import ConfigParser
 import psutil
 from pprint import pprint
 import shutil
+import subprocess
 import inspect
 import requests
 
@@ -19,6 +23,18 @@ from installed_clients.AssemblyUtilClient import AssemblyUtil
 from kb_unicycler.kb_unicyclerServer import MethodContext
 from installed_clients.WorkspaceClient import Workspace
 from installed_clients.DataFileUtilClient import DataFileUtil
+from kb_unicycler.utils.resources import (effective_cpu_count, parse_cpu_list,
+                                          cgroup_memory_limit, memory_caps_gb,
+                                          ProcessSampler)
+from kb_unicycler.utils.combine import combine_files
+from kb_unicycler.utils.reads_cache import ReadsCache
+from kb_unicycler.utils.seqscan import (fastq_read_lengths, fasta_record_lengths, index_fasta,
+                                        write_fai)
+from kb_unicycler.utils.assembly_stats import assembly_stats
+from kb_unicycler.utils.console import ConsoleLog
+from kb_unicycler.utils.unicycler_log import UnicyclerLogParser
+from installed_clients import baseclient
+from kb_unicycler.utils.ref_cache import RefCache, CachedWorkspace
 
 class unicyclerTest(unittest.TestCase):
 
@@ -314,4 +330,344 @@ class unicyclerTest(unittest.TestCase):
                             short_paired_libraries=['shigella_short'],
                             long_reads_library='shigella_assy')
 
+    def test_bad_library_ref(self):
+        params = {'workspace_name': self.getWsName(),
+                  'short_paired_libraries': ['shigella_short', 'no_such_library'],
+                  'output_contigset_name': 'bad_ref_out',
+                  'min_contig_length': 100,
+                  'min_long_read_length': 100,
+                  'num_linear_seqs': 0,
+                  'bridging_mode': 'normal'
+                  }
+        with self.assertRaisesRegex(ValueError, 'no_such_library'):
+            self.getImpl().run_unicycler(self.ctx, params)
+
+    def test_effective_cpu_count(self):
+        self.assertEqual(7, parse_cpu_list('0-3,8,10-11'))
+        cgroup_dir = os.path.join(self.scratch, 'fake_cgroup_v2')
+        os.makedirs(cgroup_dir, exist_ok=True)
+        with open(os.path.join(cgroup_dir, 'cpu.max'), 'w') as f:
+            f.write('150000 100000\n')
+        resources = effective_cpu_count(cgroup_dir)
+        self.assertEqual(1.5, resources['cpu_quota'])
+        self.assertEqual(1, resources['threads'])
+        with open(os.path.join(cgroup_dir, 'cpu.max'), 'w') as f:
+            f.write('max 100000\n')
+        resources = effective_cpu_count(cgroup_dir)
+        self.assertIsNone(resources['cpu_quota'])
+        self.assertEqual(resources['cpuset_cpus'] or resources['host_cpus'],
+                         resources['threads'])
+
+    def test_memory_caps(self):
+        cgroup_dir = os.path.join(self.scratch, 'fake_cgroup_mem')
+        os.makedirs(cgroup_dir, exist_ok=True)
+        with open(os.path.join(cgroup_dir, 'memory.max'), 'w') as f:
+            f.write(str(8 << 30) + '\n')
+        self.assertEqual(8 << 30, cgroup_memory_limit(cgroup_dir))
+        caps = memory_caps_gb(8 << 30)
+        self.assertEqual(6, caps['spades_memory_gb'])
+        self.assertEqual(6, caps['pilon_heap_gb'])
+        self.assertEqual(1, memory_caps_gb(512 << 20)['pilon_heap_gb'])
+
+    def test_combine_files(self):
+        combine_dir = os.path.join(self.scratch, 'combine_test')
+        os.makedirs(combine_dir, exist_ok=True)
+        plain = os.path.join(combine_dir, 'plain.fastq')
+        shutil.copy(os.path.join('data', 'short_reads_1.fastq.gz'), plain + '.gz')
+        with gzip.open(plain + '.gz', 'rb') as f_in, open(plain, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        with open(plain, 'rb') as f:
+            expected = f.read()
+        combined = os.path.join(combine_dir, 'combined.fastq')
+        size = combine_files([plain + '.gz', plain], combined)
+        self.assertEqual(2 * len(expected), size)
+        with open(combined, 'rb') as f:
+            self.assertEqual(expected + expected, f.read())
+        self.assertFalse(os.path.exists(plain + '.gz'))
+        self.assertFalse(os.path.exists(plain))
+
+        # compressed passthrough: gzip members are copied, plain is deflated
+        shutil.copy(os.path.join('data', 'short_reads_1.fastq.gz'), plain + '.gz')
+        with open(plain, 'wb') as f:
+            f.write(expected)
+        combined_gz = os.path.join(combine_dir, 'combined.fastq.gz')
+        combine_files([plain + '.gz', plain], combined_gz, remove=False, compress=True)
+        with gzip.open(combined_gz, 'rb') as f:
+            self.assertEqual(expected + expected, f.read())
+        self.assertTrue(os.path.exists(plain + '.gz'))
+        self.assertTrue(os.path.exists(plain))
+
+    def test_reads_cache(self):
+        cache_dir = os.path.join(self.scratch, 'reads_cache_test')
+        cache = ReadsCache(cache_dir, 1 << 20)
+        fastq = os.path.join(self.scratch, 'reads_cache_test.fastq')
+        with open(fastq, 'w') as f:
+            f.write('@read1\nACGT\n+\nIIII\n')
+        self.assertIsNone(cache.get('1/2/3', self.scratch))
+        cache.put('1/2/3', {'fwd': fastq})
+        self.assertTrue(os.path.exists(fastq))
+        files = cache.get('1/2/3', self.scratch)
+        self.assertEqual(['fwd'], list(files.keys()))
+        with gzip.open(files['fwd'], 'rt') as f:
+            self.assertEqual('@read1\nACGT\n+\nIIII\n', f.read())
+        with self.assertRaises(ValueError):
+            cache.get('ws/obj', self.scratch)
+
+    def test_fastq_read_lengths(self):
+        # the quality line of the second read starts with '@'
+        fastq = os.path.join(self.scratch, 'scan_test.fastq')
+        with open(fastq, 'w') as f:
+            f.write('@read1\nACGTACGT\n+\nIIIIIIII\n@read2\nACG\n+\n@@@\n')
+        lengths = fastq_read_lengths(fastq, chunk_size=16)
+        self.assertEqual([8, 3], lengths.tolist())
+        # blank lines at the end are fine, but not between records
+        with open(fastq, 'w') as f:
+            f.write('@read1\nACGT\n+\nIIII\n\n\n')
+        self.assertEqual([4], fastq_read_lengths(fastq, chunk_size=8).tolist())
+        with open(fastq, 'w') as f:
+            f.write('@read1\nACGT\n+\nIIII\n\n@read2\nACG\n+\nIII\n')
+        with self.assertRaises(ValueError):
+            fastq_read_lengths(fastq, chunk_size=8)
+        # but the empty lines of a zero-length read count, at the end of the
+        # file and across a chunk boundary
+        with open(fastq, 'w') as f:
+            f.write('@read1\nACG\n+\nIII\n@read2\n\n+\n\n')
+        self.assertEqual([3, 0], fastq_read_lengths(fastq, chunk_size=8).tolist())
+        with open(fastq, 'w') as f:
+            f.write('@read1\nACG\n+\nIII\n@read2\n\n+\n\n@read3\nAC\n+\nII\n\n')
+        for chunk_size in (4, 8, 16):
+            self.assertEqual([3, 0, 2], fastq_read_lengths(fastq, chunk_size=chunk_size).tolist())
+        lengths = fastq_read_lengths(os.path.join('data', 'long_reads_low_depth.fastq.gz'))
+        self.assertGreater(len(lengths), 0)
+        self.assertEqual([len(lengths), 0, int(lengths.sum())],
+                         self.getImpl().filter_short_reads(
+                             None, os.path.join('data', 'long_reads_low_depth.fastq.gz'), 0))
+
+    def test_fit_long_reads(self):
+        fastq = os.path.join(self.scratch, 'fit_test.fastq')
+        with open(fastq, 'w') as f:
+            f.write('@short\nACG\n+\nIII\n' +
+                    '@long_bad\nACGTACGT\n+\n!!!!!!!!\n' +
+                    '@long_good\nACGTACGT\n+\nIIIIIIII\n')
+        warnings = []
+        filtered, total = self.getImpl().fit_long_reads(None, warnings, fastq, 11)
+        self.assertEqual(11, total)
+        with open(filtered) as f:
+            self.assertEqual('@short\nACG\n+\nIII\n@long_good\nACGTACGT\n+\nIIIIIIII\n',
+                             f.read())
+        self.assertEqual(1, len(warnings))
+
+    def test_check_long_reads_size(self):
+        def lib(meta):
+            return {'ref': '1/2/3', 'info': [2, 'long', 'KBaseFile.SingleEndLibrary-2.0',
+                                             None, 3, None, 1, 'ws', None, 0, meta]}
+        warnings = []
+        impl = self.getImpl()
+        self.assertEqual('proceed', impl.check_long_reads_size(None, warnings,
+                                                               lib({'total_bases': '1000'})))
+        self.assertEqual('subsample', impl.check_long_reads_size(
+            None, warnings, lib({'read_count': '2000000', 'read_length_mean': '1000.5'})))
+        self.assertEqual(1, len(warnings))
+        for meta in [None, {}, {'total_bases': 'lots'}, {'Size': 'nan'},
+                     {'read_count': 'inf', 'read_length_mean': '10'}]:
+            self.assertEqual('unknown', impl.check_long_reads_size(None, warnings, lib(meta)))
+        with self.assertRaises(ValueError):
+            impl.check_long_reads_size(None, warnings, lib({'total_bases': '2e10'}))
+
+    def test_fasta_record_lengths(self):
+        fasta = os.path.join(self.scratch, 'scan_test.fasta')
+        with open(fasta, 'w') as f:
+            f.write('>contig1 length=10\nACGTA\nCGTAC\n>empty\n>contig3\nAC\n')
+        self.assertEqual([10, 0, 2], fasta_record_lengths(fasta, chunk_size=8).tolist())
+        self.assertEqual([3, 2, 12], self.getImpl().filter_short_reads(None, fasta, 5, True))
+
+    def test_load_stats(self):
+        fasta = os.path.join(self.scratch, 'stats_test.fasta')
+        with open(fasta, 'w') as f:
+            f.write('>1 length=8 depth=1.00x circular=true\nGGCCAATT\n'
+                    '>2 length=4 depth=0.52x\nACGT\n')
+        contigs = self.getImpl().load_stats([], fasta)
+        self.assertEqual(['1', '2'], contigs['id'].tolist())
+        self.assertEqual([8, 4], contigs['length'].tolist())
+        self.assertEqual([1.0, 0.52], contigs['depth'].tolist())
+        self.assertEqual([True, False], contigs['circular'].tolist())
+        self.assertEqual([0.5, 0.5], contigs['gc'].tolist())
+        write_fai(contigs, fasta + '.fai')
+        with open(fasta + '.fai') as f:
+            self.assertEqual('1\t8\t38\t8\t9\n2\t4\t71\t4\t5\n', f.read())
+
+    def test_assembly_stats(self):
+        fasta = os.path.join(self.scratch, 'assembly_stats_test.fasta')
+        with open(fasta, 'w') as f:
+            f.write('>1 length=8 depth=1.00x circular=true\nGGCCAATT\n'
+                    '>2 length=4 depth=3.00x\nACGT\n'
+                    '>3 length=6 depth=1.00x\nAAAAAA\n')
+        stats = assembly_stats(index_fasta(fasta), genome_size=10)
+        self.assertEqual(18, stats['total_length'])
+        self.assertEqual((6, 2), (stats['n50'], stats['l50']))
+        self.assertEqual((4, 3), (stats['n90'], stats['l90']))
+        self.assertEqual((8, 1), (stats['ng50'], stats['lg50']))
+        self.assertAlmostEqual(6 / 18.0, stats['gc'])
+        self.assertEqual((1, 8, 2, 10), (stats['circular_contigs'], stats['circular_length'],
+                                         stats['linear_contigs'], stats['linear_length']))
+        self.assertAlmostEqual(26 / 18.0, stats['mean_depth'])
+
+    def test_zip_folder(self):
+        zip_dir = os.path.join(self.scratch, 'zip_test')
+        os.makedirs(os.path.join(zip_dir, 'sub'), exist_ok=True)
+        for name in ('assembly.gfa', 'assembly.fasta', os.path.join('sub', 'graph.gfa')):
+            with open(os.path.join(zip_dir, name), 'w') as f:
+                f.write('ACGT' * 1000)
+        shutil.copy(os.path.join('data', 'short_reads_1.fastq.gz'), zip_dir)
+        zip_path = os.path.join(self.scratch, 'zip_test.zip')
+        self.getImpl().zip_folder(zip_dir, zip_path, exclude=['*.fasta'], threads=2)
+        with zipfile.ZipFile(zip_path) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(['sub/graph.gfa', 'zip_test/assembly.gfa',
+                              'zip_test/short_reads_1.fastq.gz'], sorted(z.namelist()))
+            self.assertEqual(zipfile.ZIP_STORED,
+                             z.getinfo('zip_test/short_reads_1.fastq.gz').compress_type)
+            self.assertEqual('ACGT' * 1000, z.read('zip_test/assembly.gfa').decode())
+
+    def test_console_log(self):
+        log_path = os.path.join(self.scratch, 'console_test.log.gz')
+        console = ConsoleLog(log_path, max_lines=2)
+        for line in ['one', 'tput: unknown terminal', '  0 / 100 (0.0%)', 'two', 'three']:
+            self.getImpl().log(console, line)
+        self.assertEqual(['two', 'three'], list(console))
+        self.assertEqual(1, console.dropped())
+        console.close()
+        console.append('four')
+        with gzip.open(log_path, 'rt') as f:
+            self.assertEqual('one\ntwo\nthree\n', f.read())
+
+    def test_unicycler_log_parser(self):
+        lines = [(0, 'Loading reads (2020-05-01 12:00:00)'),
+                 (1, '31,000 / 31,000 reads'),
+                 (10, 'Rotating completed replicons (2020-05-01 12:00:10)'),
+                 (10, 'Segment   Length     Depth   Starting gene   Position   Strand   '
+                      'Identity   Coverage'),
+                 (11, '      1   4,641,652  1.00x   dnaA            3,882,326  reverse  '
+                      '100.0%     100.0%'),
+                 (11, '      2      46,000  2.00x   none'),
+                 (12, 'Assembly complete (2020-05-01 12:00:12)')]
+        parser = UnicyclerLogParser()
+        for now, line in lines:
+            parser.feed(line, now)
+        parser.finish(15)
+        self.assertEqual([('Loading reads', 10), ('Rotating completed replicons', 2),
+                          ('Assembly complete', 3)], parser.phase_seconds())
+        self.assertEqual('dnaA', parser.rotations['1']['starting_gene'])
+        self.assertEqual('reverse', parser.rotations['1']['strand'])
+        self.assertEqual('none found', parser.rotations['2']['starting_gene'])
+
+    def test_process_sampler(self):
+        proc = subprocess.Popen('sleep 1 & sleep 1; wait', shell=True)
+        sampler = ProcessSampler(proc.pid, interval=0.2)
+        sampler.start()
+        proc.wait()
+        samples = sampler.stop()
+        self.assertGreater(len(samples), 1)
+        self.assertGreaterEqual(samples['processes'].max(), 2)
+        self.assertGreater(sampler.summary()['peak_rss'], 0)
+        csv_path = os.path.join(self.scratch, 'sampler_test.csv')
+        sampler.write_csv(csv_path)
+        with open(csv_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual('seconds,processes,cpu_percent,rss,open_files,read_bytes,write_bytes,'
+                         'scratch_bytes', lines[0])
+        self.assertEqual(len(samples) + 1, len(lines))
+
+    def test_client_sessions(self):
+        session = baseclient._get_session('http://localhost:5000/a')
+        self.assertIs(session, baseclient._get_session('http://localhost:5000/b'))
+        self.assertIsNot(session, baseclient._get_session('http://localhost:5001/a'))
+
+    def test_client_retry_methods(self):
+        self.assertTrue(baseclient._is_idempotent('Workspace.get_object_info3'))
+        self.assertTrue(baseclient._is_idempotent('ReadsUtils._check_job'))
+        self.assertTrue(baseclient._is_idempotent('ServiceWizard.get_service_status'))
+        self.assertFalse(baseclient._is_idempotent('Workspace.save_objects'))
+        self.assertFalse(baseclient._is_idempotent('ReadsUtils._get_x_submit'))
+        self.assertIn('retries', baseclient.retry_counts())
+
+    def test_ref_cache(self):
+        cache_dir = os.path.join(self.scratch, 'ref_cache_test')
+        params = {'objects': [{'ref': self.staged['shigella_short']['ref']}],
+                  'includeMetadata': 1}
+        ws = CachedWorkspace(self.wsClient, RefCache(cache_dir=cache_dir), self.token)
+        info = ws.get_object_info3(params)
+        # a new cache finds the entry on disk
+        cache = RefCache(cache_dir=cache_dir)
+        ws = CachedWorkspace(self.wsClient, cache, self.token)
+        self.assertEqual(info, ws.get_object_info3(params))
+        self.assertEqual((1, 0), (cache.hits, cache.misses))
+
+    def test_service_url_cache(self):
+        calls = []
+        dead_urls = set()
+
+        class StubClient(baseclient.BaseClient):
+            def _call(self, url, method, params, context=None, max_retries=5):
+                calls.append(method)
+                if method == 'ServiceWizard.get_service_status':
+                    return {'url': 'http://service.test/' + str(len(calls))}
+                if url in dead_urls:
+                    raise requests.exceptions.ConnectionError('connection reset')
+                return url
+
+        client = StubClient('http://wizard.test/', token='token', lookup_url=True)
+        first_url = client.call_method('Mod.get_x', [], 'release')
+        # cache hit
+        self.assertEqual(first_url, client.call_method('Mod.get_x', [], 'release'))
+        self.assertEqual(1, calls.count('ServiceWizard.get_service_status'))
+        # expired
+        key = ('http://wizard.test/', 'Mod', 'release')
+        baseclient._service_urls[key] = (first_url, 0)
+        second_url = client.call_method('Mod.get_x', [], 'release')
+        self.assertNotEqual(first_url, second_url)
+        self.assertEqual(2, calls.count('ServiceWizard.get_service_status'))
+        # looked up again after a connection error, and resent
+        dead_urls.add(second_url)
+        self.assertNotIn(client.call_method('Mod.get_x', [], 'release'), dead_urls)
+        self.assertEqual(3, calls.count('ServiceWizard.get_service_status'))
+        # but a save the server may have seen is not sent twice
+        dead_urls.add(baseclient._service_urls[key][0])
+        del calls[:]
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.call_method('Mod.save_x', [], 'release')
+        self.assertEqual(['Mod.save_x'], calls)
+
+    def test_expand_reads_sets(self):
+        pe_type = 'KBaseFile.PairedEndLibrary-2.0'
+        set_type = 'KBaseSets.ReadsSet-1.0'
+        sets = {'sets/outer': [('libs/b', pe_type), ('sets/inner', set_type)],
+                'sets/inner': [('libs/a', pe_type), ('libs/c', pe_type)]}
+        fetched = []
+
+        class StubSetAPI(object):
+            def __init__(self, url=None, token=None):
+                pass
+
+            def get_reads_set_v1(self, params, context=None):
+                fetched.append(params['ref'])
+                return {'data': {'items': [{'ref': ref, 'info': [None, None, obj_type]}
+                                           for ref, obj_type in sets[params['ref']]]}}
+
+        def lib(ref, obj_type):
+            return {'ref': ref, 'type': obj_type, 'info': None}
+        console = []
+        # libs/a is given directly and is also in the nested set
+        groups = [[lib('libs/a', 'KBaseFile.PairedEndLibrary'),
+                   lib('sets/outer', 'KBaseSets.ReadsSet'),
+                   lib('libs/d', 'KBaseFile.PairedEndLibrary')],
+                  [lib('sets/inner', 'KBaseSets.ReadsSet')]]
+        with mock.patch('kb_unicycler.kb_unicyclerImpl.SetAPI', StubSetAPI):
+            refs = self.getImpl().expand_reads_sets(console, self.token, groups)
+        # in the order given, with sets expanded in place
+        self.assertEqual([['libs/a', 'libs/b', 'libs/c', 'libs/d'], ['libs/a', 'libs/c']], refs)
+        self.assertIn('Skipping duplicate reads libraries: libs/a', console)
+        # each set is fetched once, even when it is used more than once
+        self.assertEqual(['sets/inner', 'sets/outer'], sorted(fetched))
+
     # ########################End of passed tests######################